@@ -3,15 +3,22 @@
 # Run this app with `python app.py` and
 # visit http://127.0.0.1:8050/ in your web browser.
 
+import uuid
+import datetime
+import threading
+
 import dash
 import dash_core_components as dcc
 import dash_daq as daq
 import dash_html_components as html
-from dash.dependencies import Input, Output
+import dash_table
+from dash.dependencies import Input, Output, State
 import dash_bootstrap_components as dbc
 
 from src import Flow
 from src import CpassStatus
+from src import JobQueue
+from src import AggregateStore
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
@@ -21,121 +28,303 @@ server = app.server
 project_id = 'cosmic-octane-88917'
 AVAILABLE_FLOWS = CpassStatus('cosmic-octane-88917').get_available_flows()
 LOADER = 'dot'
+LINK_SESSIONS_ROWS = 50
+POLL_INTERVAL_MS = 500
+# flows that are not loaded yet, and loaded flows with at least this many events, get an approximate view
+# from a session sample before the exact one
+APPROXIMATE_MIN_EVENTS = 500000
+# flows materialized by `python -m src.AggregateStore.materialize` are read from here instead of BigQuery.
+# Files are memory-mapped and a new nightly version is picked up without a restart
+STORE = AggregateStore()
 
 global flow
-flow = Flow(flow_name=AVAILABLE_FLOWS[0])
-
-app.layout = html.Div(children=[
-    dbc.Row(dbc.Col(html.H1(children=f'SmartFlow Analysis'))),
-    dbc.Row([dbc.Col(dcc.Dropdown(
-        id='available_flows',
-        options=[{'label': i, 'value': i} for i in AVAILABLE_FLOWS],
-        value=AVAILABLE_FLOWS[0]
-    ), width=3),
-        dbc.Col(dcc.Dropdown(id='path_name',
-                             options=[
-                                 {'label': '1-Path_Freq_Rank', 'value': '1-Path_Freq_Rank'},
-                                 {'label': '2-Path_Freq_Rank', 'value': '2-Path_Freq_Rank'},
-                                 {'label': '3-Path_Freq_Rank', 'value': '3-Path_Freq_Rank'},
-                                 {'label': '4-Path_Freq_Rank', 'value': '4-Path_Freq_Rank'},
-                                 {'label': '5-Path_Freq_Rank', 'value': '5-Path_Freq_Rank'},
-                                 {'label': '6-Path_Freq_Rank', 'value': '6-Path_Freq_Rank'},
-                                 {'label': '7-Path_Freq_Rank', 'value': '7-Path_Freq_Rank'},
-                                 {'label': '8-Path_Freq_Rank', 'value': '8-Path_Freq_Rank'},
-                                 {'label': '9-Path_Freq_Rank', 'value': '9-Path_Freq_Rank'},
-                                 {'label': '10-Path_Freq_Rank', 'value': '10-Path_Freq_Rank'},
-                             ],
-                             value='1-Path_Freq_Rank'
-                             ), width=3),
-        dbc.Col(daq.BooleanSwitch(
-            id='tollfree_toggle',
-            on=True,
-            label="Include TollFree Numbers",
-            labelPosition="top"
-        ), width=2)]),
-    dbc.Row(dbc.Col(html.H1(id='flow_name'))),
-    dbc.Row([
-        dbc.Col([dcc.Loading(
-            id="loading-1",
-            type=LOADER,
-            children=[dcc.Tabs([dcc.Tab(label='User Path Breakdown', children=[dcc.Graph(id='paths_time')]),
-                                dcc.Tab(label='Callback Analysis', children=[dcc.Graph(id='callback_analysis')])
-                                ])])], width=5),
-        dbc.Col([dcc.Loading(
-            id="loading-2",
-            type=LOADER,
-            children=[dcc.Graph(id='sankey')])], width=6),
-        dbc.Col([html.Label('Threshold'),
-                 dcc.Slider(
-                     id='threshold_slider',
-                     min=0,
-                     max=100,
-                     value=10,
-                     step=1,
-                     vertical=True
-                 )])
-    ]),
-    dbc.Row([
-
-        dbc.Col([dcc.Loading(
-            id="loading-3",
-            type=LOADER,
-            children=[dcc.Graph(id='totals_time')]),
-            dcc.RangeSlider(
-                id='date_slider',
-                min=0,
-                max=100,
-                value=[0, 100],
-                step=5,
-            )], width={"size": 10, "offset": 1}, align="center")])
-
-])
+flow = Flow(flow_name=AVAILABLE_FLOWS[0], store=STORE)
+# (flow_name, start_date, end_date, include_tollfree, data_version) the current sankey figure was built for
+built_state = None
+# jobs share the global flow of their process, the lock keeps them from modifying it at the same time
+flow_lock = threading.Lock()
+# job generations and results are files shared by every server process, so a poll can be answered
+# by any worker while each worker keeps its own flow
+jobs = JobQueue()
+
+
+def serve_layout():
+    return html.Div(children=[
+        dcc.Store(id='client_id', data=str(uuid.uuid4())),
+        dcc.Store(id='job'),
+        dcc.Store(id='shown_partial'),
+        dcc.Store(id='figure_state'),
+        dcc.Interval(id='job_poll', interval=POLL_INTERVAL_MS, disabled=True),
+        dcc.Store(id='link_job'),
+        dcc.Interval(id='link_poll', interval=POLL_INTERVAL_MS, disabled=True),
+        dbc.Row(dbc.Col(html.H1(children=f'SmartFlow Analysis'))),
+        dbc.Row([dbc.Col(dcc.Dropdown(
+            id='available_flows',
+            options=[{'label': i, 'value': i} for i in AVAILABLE_FLOWS],
+            value=AVAILABLE_FLOWS[0]
+        ), width=3),
+            dbc.Col(dcc.Dropdown(id='path_name',
+                                 options=[
+                                     {'label': '1-Path_Freq_Rank', 'value': '1-Path_Freq_Rank'},
+                                     {'label': '2-Path_Freq_Rank', 'value': '2-Path_Freq_Rank'},
+                                     {'label': '3-Path_Freq_Rank', 'value': '3-Path_Freq_Rank'},
+                                     {'label': '4-Path_Freq_Rank', 'value': '4-Path_Freq_Rank'},
+                                     {'label': '5-Path_Freq_Rank', 'value': '5-Path_Freq_Rank'},
+                                     {'label': '6-Path_Freq_Rank', 'value': '6-Path_Freq_Rank'},
+                                     {'label': '7-Path_Freq_Rank', 'value': '7-Path_Freq_Rank'},
+                                     {'label': '8-Path_Freq_Rank', 'value': '8-Path_Freq_Rank'},
+                                     {'label': '9-Path_Freq_Rank', 'value': '9-Path_Freq_Rank'},
+                                     {'label': '10-Path_Freq_Rank', 'value': '10-Path_Freq_Rank'},
+                                 ],
+                                 value='1-Path_Freq_Rank'
+                                 ), width=3),
+            dbc.Col(daq.BooleanSwitch(
+                id='tollfree_toggle',
+                on=True,
+                label="Include TollFree Numbers",
+                labelPosition="top"
+            ), width=2)]),
+        dbc.Row(dbc.Col(html.H1(id='flow_name'))),
+        dbc.Row([
+            dbc.Col([dcc.Loading(
+                id="loading-1",
+                type=LOADER,
+                children=[dcc.Tabs([dcc.Tab(label='User Path Breakdown', children=[dcc.Graph(id='paths_time')]),
+                                    dcc.Tab(label='Callback Analysis', children=[dcc.Graph(id='callback_analysis')])
+                                    ])])], width=5),
+            dbc.Col([dcc.Loading(
+                id="loading-2",
+                type=LOADER,
+                children=[dcc.Graph(id='sankey')]),
+                html.Div(id='link_sessions')], width=6),
+            dbc.Col([html.Label('Threshold'),
+                     dcc.Slider(
+                         id='threshold_slider',
+                         min=0,
+                         max=100,
+                         value=10,
+                         step=1,
+                         vertical=True
+                     )])
+        ]),
+        dbc.Row([
+
+            dbc.Col([dcc.Loading(
+                id="loading-3",
+                type=LOADER,
+                children=[dcc.Graph(id='totals_time')]),
+                dcc.RangeSlider(
+                    id='date_slider',
+                    min=0,
+                    max=100,
+                    value=[0, 100],
+                    step=5,
+                )], width={"size": 10, "offset": 1}, align="center")])
+
+    ])
+
+
+app.layout = serve_layout
+
+
+def page_figures(fig_sankey, flow_name):
+    """ Adds the time series figures of the global flow to a sankey figure, in callback output order,
+        followed by the state the figures were built for
+    """
+    fig_totals_time = flow.distinct_sessionId_count_plot()
+    fig_paths_time = flow.top_paths_plot()
+    callback_analysis = flow.callback_analysis()
+    state = [flow_name, flow.start_date.isoformat(), flow.end_date.isoformat(), flow.include_tollfree]
+    return fig_sankey, fig_paths_time, callback_analysis, fig_totals_time, flow_name, state
+
+
+def use_flow(flow_name, tollfree_toggle):
+    """ Replaces the global flow when another flow is requested, called with flow_lock held
+
+    :return: True if the flow was replaced
+    """
+    global flow, built_state
+    if flow_name == flow._flow_name:
+        return False
+    print(f"New Flow {flow_name}")
+    flow = Flow(flow_name=flow_name, start_date=None, end_date=None, include_tollfree=tollfree_toggle,
+                store=STORE)
+    built_state = None
+    return True
+
+
+def compute_figures(token, threshold, flow_name, date_range, path_name, tollfree_toggle):
+    """ Builds every figure of the page. Runs on the job queue, the token stops it at
+        the next stage boundary once the same client has submitted newer inputs.
+        Large flows publish an approximate view first and then compute the exact one.
+    """
+    global flow, built_state
+    with flow_lock:
+        token.check('update_figure')
+        new_flow = use_flow(flow_name, tollfree_toggle)
+        flow.cancel_token = token
+        try:
+            # a new version of a materialized flow invalidates the sankey built from the previous one
+            if new_flow:
+                state = (flow_name, flow.start_date, flow.end_date, tollfree_toggle, flow.data_version())
+            else:
+                state = (flow_name,
+                         flow.date_at_percent(date_range[0]),
+                         flow.date_at_percent(date_range[1]),
+                         tollfree_toggle,
+                         flow.data_version())
+            if state == built_state:
+                flow.threshold = threshold
+                flow.path_highlight = path_name
+                fig_sankey = flow.sankey_modify_path_highlight(path_name)
+            else:
+                print("Change dates")
+                # a cancelled rebuild leaves the flow half updated, so it must not be reused
+                built_state = None
+                flow.start_date, flow.end_date = state[1], state[2]
+                flow.threshold = threshold
+                flow.set_tollfree_toggle(tollfree_toggle)
+                flow.path_highlight = path_name
+                if flow.approximate_available(APPROXIMATE_MIN_EVENTS):
+                    flow.approximate = True
+                    try:
+                        token.publish(page_figures(flow.sankey_plot(), flow_name))
+                    finally:
+                        flow.approximate = False
+                fig_sankey = flow.sankey_plot()
+                built_state = state
+                jobs.submit(f"{token.client_id}:session_index", build_session_index, flow_name)
+            return page_figures(fig_sankey, flow_name)
+        finally:
+            flow.cancel_token = None
+
+
+def build_session_index(token, flow_name):
+    """ Builds the SessionIndex of the global flow after its figures, from the same SessionSequence
+        the figures were built from, so the first Sankey link click does not wait for it
+    """
+    with flow_lock:
+        token.check('session_index')
+        if flow._flow_name == flow_name:
+            flow.session_index()
 
 
 @app.callback(
-    [Output('sankey', 'figure'),
-     Output('paths_time', 'figure'),
-     Output('callback_analysis', 'figure'),
-     Output('totals_time', 'figure'),
-     Output('flow_name', 'children')],
+    Output('job', 'data'),
     [Input('threshold_slider', 'value'),
      Input('available_flows', 'value'),
      Input('date_slider', 'value'),
      Input('path_name', 'value'),
-     Input('tollfree_toggle', 'on')])
-def update_figure(threshold, flow_name, date_range, path_name, tollfree_toggle):
+     Input('tollfree_toggle', 'on')],
+    [State('client_id', 'data')])
+def update_figure(threshold, flow_name, date_range, path_name, tollfree_toggle, client_id):
     print(f"threshold: {threshold} "
           f"flow_name: {flow_name} "
           f"date_range: {date_range} "
           f"path_name: {path_name} "
           f"tollfree_toggle: {tollfree_toggle}")
-    global flow
-    new_start_date, new_end_date = flow.date_at_percent(date_range[0]), flow.date_at_percent(date_range[1])
-    if (flow_name == flow._flow_name
-            and new_start_date == flow.start_date
-            and new_end_date == flow.end_date
-            and tollfree_toggle == flow.include_tollfree):
-        flow.threshold = threshold
-        flow.path_highlight = path_name
-        fig_sankey = flow.sankey_modify_path_highlight(path_name)
-    elif flow_name == flow._flow_name:
-        print("Change dates")
-        flow.start_date = new_start_date
-        flow.end_date = new_end_date
-        flow.threshold = threshold
-        flow.set_tollfree_toggle(tollfree_toggle)
-        flow.path_highlight = path_name
-        fig_sankey = flow.sankey_plot()
-    else:
-        print(f"New Flow {flow_name}")
-        flow = Flow(flow_name=flow_name, start_date=None, end_date=None, include_tollfree=tollfree_toggle)
-        flow.threshold = threshold
-        flow.path_highlight = path_name
-        fig_sankey = flow.sankey_plot()
-    fig_totals_time = flow.distinct_sessionId_count_plot()
-    fig_paths_time = flow.top_paths_plot()
-    callback_analysis = flow.callback_analysis()
-    return fig_sankey, fig_paths_time, callback_analysis, fig_totals_time, flow_name
+    generation = jobs.submit(client_id, compute_figures,
+                             threshold, flow_name, date_range, path_name, tollfree_toggle)
+    return {'client_id': client_id, 'generation': generation}
+
+
+@app.callback(
+    [Output('sankey', 'figure'),
+     Output('paths_time', 'figure'),
+     Output('callback_analysis', 'figure'),
+     Output('totals_time', 'figure'),
+     Output('flow_name', 'children'),
+     Output('figure_state', 'data'),
+     Output('job_poll', 'disabled'),
+     Output('shown_partial', 'data')],
+    [Input('job_poll', 'n_intervals'),
+     Input('job', 'data')],
+    [State('shown_partial', 'data')])
+def poll_figures(n_intervals, job, shown_partial):
+    no_figures = [dash.no_update] * 6
+    if job is None:
+        return no_figures + [True, dash.no_update]
+    status, result = jobs.status(job['client_id'], job['generation'])
+    if status == 'pending':
+        partial = jobs.partial(job['client_id'], job['generation'])
+        published = None if partial is None else [job['client_id'], job['generation'], partial[0]]
+        if partial is not None and published != shown_partial:
+            # approximate view, keep polling for the exact one
+            return list(partial[1]) + [False, published]
+        return no_figures + [False, dash.no_update]
+    if status == 'done':
+        return list(result) + [True, dash.no_update]
+    if status == 'error':
+        print(f"Job {job['client_id']}:{job['generation']} failed: {result!r}")
+    if status == 'unknown':
+        print(f"Job {job['client_id']}:{job['generation']} not found in {jobs.state_dir}, "
+              f"it expired or the server processes do not share the directory")
+    # cancelled jobs have been replaced by a newer one that updates the job store
+    return no_figures + [True, dash.no_update]
+
+
+def compute_link_sessions(token, source, target, path_nickname, figure_state):
+    """ Lists the sessions behind a Sankey link using the flow's SessionIndex. Runs on the
+        job queue because it waits for running figure jobs and may build the index.
+        The job can run in another process than the figures, so the flow is first set
+        to the state the clicked figure was built for.
+    """
+    global built_state
+    flow_name, start_date, end_date, include_tollfree = figure_state
+    start_date, end_date = datetime.date.fromisoformat(start_date), datetime.date.fromisoformat(end_date)
+    with flow_lock:
+        token.check('link_sessions')
+        use_flow(flow_name, include_tollfree)
+        if (flow.start_date, flow.end_date, flow.include_tollfree) != (start_date, end_date, include_tollfree):
+            # the sankey of this process no longer matches the flow's state
+            built_state = None
+            flow.start_date, flow.end_date = start_date, end_date
+            flow.set_tollfree_toggle(include_tollfree)
+        sessions = flow.link_sessions(source, target, path_nickname)
+    summary = (f"{len(sessions)} sessions went from {source} to {target} on path {path_nickname}, "
+               f"average duration {round(sessions['session_duration'].mean(), 1)} seconds")
+    table = dash_table.DataTable(columns=[{'name': column, 'id': column} for column in sessions.columns],
+                                 data=sessions.head(LINK_SESSIONS_ROWS).astype(str).to_dict('records'),
+                                 page_size=10)
+    return [html.P(summary), table]
+
+
+@app.callback(
+    Output('link_job', 'data'),
+    [Input('sankey', 'clickData')],
+    [State('client_id', 'data'),
+     State('figure_state', 'data')])
+def request_link_sessions(click_data, client_id, figure_state):
+    if click_data is None or figure_state is None or 'source' not in click_data['points'][0]:
+        return None
+    point = click_data['points'][0]
+    path_nickname = point.get('customdata')
+    # links of approximate figures carry [path_nickname, count_error]
+    if isinstance(path_nickname, list):
+        path_nickname = path_nickname[0]
+    # link jobs are keyed apart from figure jobs so a click does not cancel a figure update
+    link_client_id = f"{client_id}:link_sessions"
+    generation = jobs.submit(link_client_id, compute_link_sessions,
+                             point['source']['label'], point['target']['label'], path_nickname, figure_state)
+    return {'client_id': link_client_id, 'generation': generation}
+
+
+@app.callback(
+    [Output('link_sessions', 'children'),
+     Output('link_poll', 'disabled')],
+    [Input('link_poll', 'n_intervals'),
+     Input('link_job', 'data')])
+def poll_link_sessions(n_intervals, link_job):
+    if link_job is None:
+        return None, True
+    status, result = jobs.status(link_job['client_id'], link_job['generation'])
+    if status == 'pending':
+        return html.P('Finding sessions...'), False
+    if status == 'done':
+        return result, True
+    if status == 'error':
+        print(f"Job {link_job['client_id']}:{link_job['generation']} failed: {result!r}")
+    return dash.no_update, True
 
 
 if __name__ == '__main__':
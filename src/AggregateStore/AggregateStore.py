@@ -0,0 +1,255 @@
+import os
+import json
+import uuid
+import shutil
+import tempfile
+import datetime
+import threading
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+
+from src import SessionSequence
+
+
+class AggregateStore:
+    """ Local store of per-day aggregate tables, one directory per flow.
+
+        Every table is keyed by date (and TollFreeNumber where the dashboard
+        filters on it) and only holds sums and counts, so any date range can be
+        rebuilt by summing rows. Next to the tables a flow can hold its events as a
+        SessionSequence, so the event level data is available without BigQuery.
+
+        Each write creates a new version directory of uncompressed Arrow IPC tables
+        and .npy sequence arrays, then atomically replaces the flow's CURRENT file
+        with the new version id. The sequence, vocabularies included, is memory-mapped
+        read-only, so every process reading a flow shares one page cache copy of its
+        events. The aggregate tables are small and are converted to a pandas copy in
+        each process. Readers pick up a new version the next time they check CURRENT
+        without being restarted, and older versions are kept for readers that still
+        have them mapped.
+    """
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    tables = ['daily_sessions', 'daily_paths', 'daily_callbacks', 'daily_edges', 'daily_node_ranks']
+    manifest_file = 'manifest.json'
+    current_file = 'CURRENT'
+    sequence_dir = 'sequence'
+    # versions kept on disk including the current one
+    keep_versions = 2
+
+    def __init__(self, root: str = None) -> None:
+        """
+        :param root: directory containing the flow directories, defaults to data/ in this module
+        """
+        self.root = root if root is not None else os.path.join(self.dir_path, 'data')
+        # flow_name -> (version, data) of the latest version opened by this process
+        self._tables: Dict[str, Tuple[str, Dict[str, pd.DataFrame]]] = {}
+        self._sequences: Dict[str, Tuple[str, SessionSequence]] = {}
+        self._lock = threading.Lock()
+
+    def _flow_dir(self, flow_name: str) -> str:
+        return os.path.join(self.root, quote(flow_name, safe=''))
+
+    def _version_dir(self, flow_name: str, version: str = None) -> Optional[str]:
+        version = version if version is not None else self.current_version(flow_name)
+        return os.path.join(self._flow_dir(flow_name), version) if version is not None else None
+
+    def current_version(self, flow_name: str) -> Optional[str]:
+        """ Returns the id of the version readers should use, None if the flow was never materialized
+        """
+        try:
+            with open(os.path.join(self._flow_dir(flow_name), self.current_file)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def manifest(self, flow_name: str, version: str = None) -> Optional[Dict[str, Any]]:
+        """ Returns the manifest written with the flow's tables, None if the flow was never materialized
+
+        :param flow_name: name of the flow
+        :param version: version id, defaults to the current version
+        """
+        version_dir = self._version_dir(flow_name, version)
+        if version_dir is None:
+            return None
+        try:
+            with open(os.path.join(version_dir, self.manifest_file)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def has_flow(self, flow_name: str) -> bool:
+        return self.manifest(flow_name) is not None
+
+    def load_flow(self, flow_name: str, version: str = None) -> Dict[str, pd.DataFrame]:
+        """ Reads every aggregate table of a flow into pandas. The tables of the latest
+            version read are kept, so reloading it costs nothing.
+
+        :param flow_name: name of the flow
+        :param version: version id, defaults to the current version
+        :return: dictionary of table name to dataframe
+        """
+        version = version if version is not None else self.current_version(flow_name)
+        with self._lock:
+            cached = self._tables.get(flow_name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        version_dir = self._version_dir(flow_name, version)
+        tables = {table: feather.read_table(os.path.join(version_dir, f"{table}.arrow"), memory_map=True).to_pandas()
+                  for table in self.tables}
+        with self._lock:
+            self._tables[flow_name] = (version, tables)
+        return tables
+
+    def has_sequence(self, flow_name: str, version: str = None) -> bool:
+        version_dir = self._version_dir(flow_name, version)
+        return (version_dir is not None
+                and os.path.exists(os.path.join(version_dir, self.sequence_dir, SessionSequence.meta_file)))
+
+    def load_sequence(self, flow_name: str, version: str = None) -> Optional[SessionSequence]:
+        """ Maps the events of a flow read-only, None if they were not materialized
+
+        :param flow_name: name of the flow
+        :param version: version id, defaults to the current version
+        :return: sequence whose arrays are numpy memmaps shared with every other process reading them
+        """
+        version = version if version is not None else self.current_version(flow_name)
+        with self._lock:
+            cached = self._sequences.get(flow_name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if not self.has_sequence(flow_name, version):
+            return None
+        sequence = SessionSequence.load(os.path.join(self._version_dir(flow_name, version), self.sequence_dir),
+                                        mmap_mode='r')
+        with self._lock:
+            self._sequences[flow_name] = (version, sequence)
+        return sequence
+
+    def write_flow(self,
+                   flow_name: str,
+                   tables: Dict[str, pd.DataFrame],
+                   manifest: Dict[str, Any],
+                   sequence: SessionSequence = None) -> str:
+        """ Writes a new version of the aggregate tables of a flow and makes it the current one
+
+        :param flow_name: name of the flow
+        :param tables: dictionary of table name to dataframe, as returned by build_aggregates
+        :param manifest: information about the run stored next to the tables
+        :param sequence: events of the flow, optional
+        :return: id of the new version
+        """
+        flow_dir = self._flow_dir(flow_name)
+        os.makedirs(flow_dir, exist_ok=True)
+        version = f"{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        tmp_dir = tempfile.mkdtemp(dir=flow_dir, prefix='.tmp-')
+        try:
+            for table, df in tables.items():
+                # uncompressed so readers can map the buffers instead of decoding them
+                feather.write_feather(pa.Table.from_pandas(df, preserve_index=False),
+                                      os.path.join(tmp_dir, f"{table}.arrow"),
+                                      compression='uncompressed')
+            if sequence is not None:
+                sequence.save(os.path.join(tmp_dir, self.sequence_dir))
+            with open(os.path.join(tmp_dir, self.manifest_file), 'w') as f:
+                json.dump(dict(manifest, flow_name=flow_name, version=version), f, default=str)
+            os.replace(tmp_dir, os.path.join(flow_dir, version))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        current_tmp = os.path.join(flow_dir, f".{self.current_file}-{uuid.uuid4().hex}")
+        with open(current_tmp, 'w') as f:
+            f.write(version)
+        os.replace(current_tmp, os.path.join(flow_dir, self.current_file))
+        self.prune(flow_name)
+        return version
+
+    def prune(self, flow_name: str) -> None:
+        """ Removes all but the keep_versions newest versions of a flow. Processes that
+            still map files of a removed version keep reading them until they unmap them.
+        """
+        flow_dir = self._flow_dir(flow_name)
+        current = self.current_version(flow_name)
+        versions = sorted(name for name in os.listdir(flow_dir)
+                          if not name.startswith('.') and os.path.isdir(os.path.join(flow_dir, name)))
+        for version in versions[:-self.keep_versions]:
+            if version != current:
+                shutil.rmtree(os.path.join(flow_dir, version), ignore_errors=True)
+
+    @staticmethod
+    def filter(df: pd.DataFrame,
+               start_date: datetime.date = None,
+               end_date: datetime.date = None,
+               include_tollfree: bool = True) -> pd.DataFrame:
+        """ Selects the rows of an aggregate table the same way Flow.create_user_sequence
+            selects events: on or after start_date, before end_date
+
+        :param df: aggregate table
+        :param start_date: first date included
+        :param end_date: first date excluded
+        :param include_tollfree: if False only NonTollFree rows are kept
+        :return: filtered aggregate table
+        """
+        keep = pd.Series(True, index=df.index)
+        if start_date is not None:
+            keep &= df['date'] >= pd.Timestamp(start_date)
+        if end_date is not None:
+            keep &= df['date'] < pd.Timestamp(end_date)
+        if not include_tollfree and 'TollFreeNumber' in df.columns:
+            keep &= df['TollFreeNumber'] == 'NonTollFree'
+        return df[keep]
+
+    @staticmethod
+    def build_aggregates(sequence: SessionSequence) -> Dict[str, pd.DataFrame]:
+        """ Reduces the events of a flow to the per-day tables read by the dashboard. Every
+            session is counted on the day of its first event.
+
+        :param sequence: events of the flow, with TollFreeNumber if the calling numbers were classified
+        :return: dictionary of table name to dataframe
+        """
+        by = ['date', 'TollFreeNumber']
+        sessions = sequence.session_metrics()
+        sessions['TollFreeNumber'] = sessions['TollFreeNumber'].fillna('Unknown')
+
+        daily_sessions = (sessions.groupby(['date', 'FlowName'])
+                          .agg(count=('events', 'sum'), sessions=('user_id', 'size'))
+                          .reset_index())
+
+        daily_paths = (sessions.groupby(by + ['path_nickname'])
+                       .agg(events=('events', 'sum'),
+                            sessions=('user_id', 'size'),
+                            duration_sum=('session_duration', 'sum'),
+                            duration_n=('session_duration', 'count'))
+                       .reset_index())
+
+        # sessions without a classified calling number are not part of the callback analysis
+        aggs = {'sessions': ('user_id', 'size')}
+        for metric in ['session_duration', 'previous_duration', 'days_since_last_call']:
+            aggs[f"{metric}_sum"] = (metric, 'sum')
+            aggs[f"{metric}_n"] = (metric, 'count')
+        daily_callbacks = (sessions[sessions['TollFreeNumber'] != 'Unknown']
+                           .groupby(by).agg(**aggs).reset_index())
+
+        edges = sequence.transitions(by=by + ['path_nickname'])
+        daily_edges = (edges[edges['path_nickname'].notna()]
+                       .assign(TollFreeNumber=edges['TollFreeNumber'].fillna('Unknown'), time_n=edges['count'])
+                       [by + ['event_name', 'next_event', 'path_nickname', 'count', 'time_sum', 'time_n']]
+                       .reset_index(drop=True))
+
+        node_ranks = []
+        for cat_col in ['event_name', 'next_event']:
+            ranks = sequence.node_ranks(by=by, next_event=cat_col == 'next_event')
+            ranks['TollFreeNumber'] = ranks['TollFreeNumber'].fillna('Unknown')
+            ranks['column'] = cat_col
+            node_ranks.append(ranks)
+        daily_node_ranks = pd.concat(node_ranks, ignore_index=True)
+
+        return {'daily_sessions': daily_sessions,
+                'daily_paths': daily_paths,
+                'daily_callbacks': daily_callbacks,
+                'daily_edges': daily_edges,
+                'daily_node_ranks': daily_node_ranks}
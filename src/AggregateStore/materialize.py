@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List
+
+from src import AggregateStore
+from src import SessionSequence
+from src import CpassStatus
+from src import Flow
+
+project_id = 'cosmic-octane-88917'
+
+
+def materialize_flow(flow_name: str,
+                     store_root: str,
+                     run_id: str,
+                     start_date: datetime.date,
+                     end_date: datetime.date) -> Dict[str, Any]:
+    """ Runs the Flow pipeline for one flow and writes its aggregate tables to the store.
+        Runs inside a worker process.
+
+    :param flow_name: name of the flow
+    :param store_root: root directory of the AggregateStore
+    :param run_id: identifier of the batch run, stored in the manifest to allow resuming
+    :param start_date: first date queried
+    :param end_date: last date queried
+    :return: report containing the flow name, row count and seconds spent per stage
+    """
+    timings = {}
+    start_time = time.time()
+    flow = Flow(flow_name=flow_name, start_date=start_date, end_date=end_date, include_tollfree=True)
+    flow._get_master()
+    timings['query'] = round(time.time() - start_time, 2)
+
+    start_time = time.time()
+    sequence = SessionSequence.from_events(flow.master)
+    timings['sequence'] = round(time.time() - start_time, 2)
+
+    start_time = time.time()
+    tables = AggregateStore.build_aggregates(sequence)
+    timings['aggregate'] = round(time.time() - start_time, 2)
+
+    start_time = time.time()
+    manifest = {'run_id': run_id,
+                'start_date': start_date,
+                'end_date': end_date,
+                'rows': len(flow.master),
+                'created': datetime.datetime.utcnow().isoformat(),
+                'timings': timings}
+    version = AggregateStore(store_root).write_flow(flow_name, tables, manifest, sequence)
+    timings['write'] = round(time.time() - start_time, 2)
+    return {'flow_name': flow_name, 'status': 'done', 'rows': len(flow.master), 'version': version,
+            'timings': timings}
+
+
+def print_report(reports: List[Dict[str, Any]]) -> None:
+    """ Prints one line per flow with the seconds spent in each stage
+    """
+    print(f"{'flow':<50} {'status':<8} {'rows':>10} {'query':>8} {'aggregate':>10} {'sequence':>9} {'write':>8}")
+    for report in sorted(reports, key=lambda r: r['flow_name']):
+        timings = report.get('timings', {})
+        print(f"{report['flow_name']:<50} {report['status']:<8} {report.get('rows', ''):>10} "
+              f"{timings.get('query', ''):>8} {timings.get('aggregate', ''):>10} {timings.get('sequence', ''):>9} "
+              f"{timings.get('write', ''):>8}")
+
+
+def main(argv: List[str] = None) -> None:
+    """ Nightly entry point that materializes the aggregates of every available flow.
+        Flows already written by the same run id are skipped, so an interrupted run
+        resumes where it stopped when started again with the same --run-id.
+
+    Example: python -m src.AggregateStore.materialize --workers 4
+    """
+    parser = argparse.ArgumentParser(description='Materialize per-day aggregates for every flow')
+    parser.add_argument('--store', default=None, help='AggregateStore root directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--run-id', default=None,
+                        help='flows already materialized with this run id are skipped, defaults to --end-date')
+    parser.add_argument('--start-date', type=datetime.date.fromisoformat, default=datetime.date(2020, 1, 1))
+    # the current day is still receiving calls, so by default only complete days are materialized
+    parser.add_argument('--end-date', type=datetime.date.fromisoformat,
+                        default=datetime.date.today() - datetime.timedelta(days=1),
+                        help='last date materialized, defaults to yesterday')
+    parser.add_argument('--flows', nargs='*', help='only materialize these flows')
+    parser.add_argument('--force', action='store_true', help='rebuild flows already done in this run')
+    args = parser.parse_args(argv)
+    # derived from the data range so a run restarted after midnight still resumes
+    if args.run_id is None:
+        args.run_id = args.end_date.isoformat()
+
+    store = AggregateStore(args.store)
+    flows = args.flows if args.flows else CpassStatus(project_id).get_available_flows()
+    pending, reports = [], []
+    for flow_name in flows:
+        manifest = store.manifest(flow_name)
+        if not args.force and manifest is not None and manifest.get('run_id') == args.run_id:
+            reports.append({'flow_name': flow_name, 'status': 'skipped', 'rows': manifest.get('rows'),
+                            'timings': manifest.get('timings', {})})
+        else:
+            pending.append(flow_name)
+    print(f"Materializing {len(pending)} flows, {len(flows) - len(pending)} already done in run {args.run_id}")
+
+    start_time = time.time()
+    # spawned workers create their own BigQuery client and query threads, forked ones would inherit
+    # the parent's scheduler without its threads and wait forever on their queries
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(materialize_flow, flow_name, store.root, args.run_id,
+                                   args.start_date, args.end_date): flow_name
+                   for flow_name in pending}
+        for future in as_completed(futures):
+            flow_name = futures[future]
+            try:
+                report = future.result()
+                print(f"Finished {flow_name} in {sum(report['timings'].values())} seconds")
+            except Exception as e:
+                print(f"Failed {flow_name}: {e!r}")
+                report = {'flow_name': flow_name, 'status': 'failed', 'error': repr(e)}
+            reports.append(report)
+
+    print_report(reports)
+    print(f"Run {args.run_id} finished in {round(time.time() - start_time, 0)} seconds")
+    os.makedirs(os.path.join(store.root, 'reports'), exist_ok=True)
+    with open(os.path.join(store.root, 'reports', f"{args.run_id}.json"), 'w') as f:
+        json.dump(reports, f, indent=2, default=str)
+    if any(report['status'] == 'failed' for report in reports):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
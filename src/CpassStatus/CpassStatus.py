@@ -1,5 +1,6 @@
 import os
 from src import Utilities
+from src import QueryScheduler
 
 
 
@@ -11,5 +12,8 @@ class CpassStatus:
 
     def get_available_flows(self):
         query = Utilities.open_sql(self.dir_path, 'flownames.sql')
-        df = self.client.query(query).to_dataframe()
+        # concurrent callers asking for the same project share one BigQuery job
+        future = QueryScheduler.shared().submit(('flownames.sql', self.project_id),
+                                                lambda: self.client.query(query).to_dataframe())
+        df = future.result()
         return df['FlowName'].to_list()
@@ -7,24 +7,41 @@ import pytz
 import plotly.express as px
 from plotly.subplots import make_subplots
 import time
-from anycache import anycache
+import numpy as np
+from concurrent.futures import Future
 
 from src import SankeyFlow
+from src import NumberClassifier
+from src import QueryCache
+from src import QueryScheduler
+from src import SessionSequence
+from src import AggregateStore
+from src import SessionIndex
+from src import HyperLogLog
+from src import Funnel
 from src import Utilities
 
 # credential_path = "/home/kerri/bigquery-jaya-consultant-cosmic-octane-88917-c46ba9b53a3b.json"
 project_id = 'cosmic-octane-88917'
 client = Utilities.get_bigquery_client(project_id)
+query_cache = QueryCache(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data/query_cache'))
 
 
 class Flow(SankeyFlow):
     dir_path = os.path.dirname(os.path.realpath(__file__))
+    # approximate mode plots a session sample and HyperLogLog distinct counts
+    approximate = False
+    sample_rate = 0.1
+    min_stratum_sessions = 100
+    sketch_precision = 12
 
     def __init__(self,
                  flow_name: str,
                  start_date: datetime.date = None,
                  end_date: datetime.date = None,
-                 include_tollfree=False) -> None:
+                 include_tollfree=False,
+                 number_classifier: NumberClassifier = None,
+                 store: AggregateStore = None) -> None:
         super().__init__()
         self._flow_name = flow_name
         self.start_date = start_date if start_date is not None else (datetime
@@ -33,12 +50,16 @@ class Flow(SankeyFlow):
                                                                      .date())
         self.end_date = end_date if end_date is not None else datetime.date.today()
         self.include_tollfree = include_tollfree
+        self.number_classifier = (number_classifier if number_classifier is not None
+                                  else NumberClassifier.for_flow(flow_name))
+        self.store = store
 
     def set_tollfree_toggle(self, value: bool) -> None:
         if value != self.include_tollfree:
             print(f"include_tollfree changed from {self.include_tollfree} to {value}")
             self.include_tollfree = value
-            self._data = self.create_user_sequence()
+            if hasattr(self, '_sequence'):
+                self._data = self._apply_tollfree_toggle()
 
     def date_at_percent(self, percentage: int):
         """ Given an int that represents a percentage from zero to 100 the function returns
@@ -52,13 +73,97 @@ class Flow(SankeyFlow):
         if percentage < 0 or percentage > 100:
             raise Exception("percentage must be between 0 and 100")
 
-        if hasattr(self, 'master') == False:
-            self._get_master()
-        start, end = self.master['time_event'].min(), self.master['time_event'].max()
+        if self._has_aggregates():
+            dates = self._aggregates['daily_sessions']['date']
+            start, end = dates.min(), dates.max()
+        else:
+            if hasattr(self, 'master') == False:
+                self._get_master()
+            start, end = self.master['time_event'].min(), self.master['time_event'].max()
         delta_from_start = (end - start) * percentage / 100
         date = (start + delta_from_start).to_pydatetime().date()
         return date
 
+    def _has_aggregates(self) -> bool:
+        """ Loads the flow's tables from the aggregate store the first time it is called,
+            and again whenever the store publishes a new version of the flow
+
+        :return: True if the plots can be built from pre-materialized aggregates
+        """
+        if self.store is None:
+            return False
+        version = self.store.current_version(self._flow_name)
+        if hasattr(self, '_aggregates') == False or version != self._aggregates_version:
+            if hasattr(self, '_aggregates_version') and self._aggregates_version is not None:
+                print(f"Flow {self._flow_name} refreshed from version {self._aggregates_version} to {version}")
+                # everything built from the events of the previous version, the sankey included
+                for attribute in ['master', '_sequence', '_sequence_nontollfree', '_nontollfree_mask',
+                                  '_session_index', '_session_sketches', '_session_sequence', '_funnel_engine',
+                                  '_live_aggregates', 'sourceTargetDf', 'labelList', 'colorList', 'title']:
+                    self.__dict__.pop(attribute, None)
+                self._data = None
+            self._aggregates_version = version
+            self._aggregates = self.store.load_flow(self._flow_name, version) if version is not None else None
+            self._manifest = self.store.manifest(self._flow_name, version) if version is not None else None
+            if self._aggregates is not None:
+                print(f"Using materialized aggregates for {self._flow_name} version {version}")
+        return self._aggregates is not None
+
+    def data_version(self) -> Optional[str]:
+        """ Returns the aggregate store version the flow currently reads, None for flows that
+            are queried from BigQuery. Figures built for another version must be rebuilt.
+        """
+        return self._aggregates_version if self._has_aggregates() else None
+
+    def _materialized_note(self, end_date: datetime.date = None) -> Optional[str]:
+        """ Returns a note with the last day of the materialized data when the selected range ends
+            after it, since the days after the last nightly run are not in the aggregate store
+
+        :param end_date: first date excluded from the selection, defaults to self.end_date
+        :return: note to add to figure titles, None if nothing is hidden
+        """
+        if not self._has_aggregates() or self._manifest is None or self._manifest.get('end_date') is None:
+            return None
+        through = datetime.date.fromisoformat(str(self._manifest['end_date'])[:10])
+        end_date = end_date if end_date is not None else self.end_date
+        if end_date <= through + datetime.timedelta(days=1):
+            return None
+        return f"Materialized data through {through}"
+
+    def _set_title(self, fig: go.Figure, title: str = None) -> go.Figure:
+        """ Sets the title of a figure followed by the materialized data note, if any
+        """
+        parts = [part for part in (title, self._materialized_note()) if part is not None]
+        if parts:
+            fig.update_layout(title=' - '.join(parts))
+        return fig
+
+    def _aggregate(self, table: str) -> pd.DataFrame:
+        """ Returns the rows of an aggregate table inside this instance's date range and
+            tollfree setting
+        """
+        return AggregateStore.filter(self._tables()[table], self.start_date, self.end_date, self.include_tollfree)
+
+    def _tables(self) -> Dict[str, pd.DataFrame]:
+        """ Returns the per-day tables of the flow: the materialized aggregates when the flow is in
+            the store, otherwise the same tables built once from the flow's SessionSequence
+        """
+        if self._has_aggregates():
+            return self._aggregates
+        if hasattr(self, '_live_aggregates') == False:
+            sequence = self.session_sequence()
+            self._check_cancelled('build_aggregates')
+            start_time = time.time()
+            self._live_aggregates = AggregateStore.build_aggregates(sequence)
+            print(f"Aggregates built in {round(time.time() - start_time, 2)} seconds")
+        return self._live_aggregates
+
+    def _use_tables(self) -> bool:
+        """ Returns True if the plots are built from the per-day tables, which is always the case
+            except for the approximate view of a flow that is not materialized
+        """
+        return self._has_aggregates() or not self.approximate
+
     def plot_traces(self, fig: go.Figure,
                     data: pd.DataFrame,
                     x: str,
@@ -179,34 +284,10 @@ class Flow(SankeyFlow):
 
     def callback_analysis(self) -> None:
         print("Creating callback_analysis")
-        if hasattr(self, '_data') == False:
-            self._data = self.create_user_sequence(self.start_date, self.end_date)
-
-        df = self._data.copy()
-        session_df = df.groupby(['user_id', 'date', 'TollFreeNumber']).agg({'session_duration': ['mean'],
-                                                                            'previous_duration': ['mean'],
-                                                                            'days_since_last_call': ['mean'],
-                                                                            'count': ['mean']},
-                                                                           as_index=False).reset_index()
-        session_df = pd.DataFrame({'user_id': session_df['user_id'],
-                                   'date': session_df['date'],
-                                   'TollFreeNumber': session_df['TollFreeNumber'],
-                                   'session_duration': session_df['session_duration']['mean'],
-                                   'previous_duration': session_df['previous_duration']['mean'],
-                                   'days_since_last_call': session_df['days_since_last_call']['mean'],
-                                   'count': [1] * len(session_df)
-                                   })
-        path_metrics = session_df.groupby(['date', 'TollFreeNumber']).agg({'session_duration': ['mean'],
-                                                                           'previous_duration': ['mean'],
-                                                                           'days_since_last_call': ['mean'],
-                                                                           'count': ['sum']},
-                                                                          as_index=False).reset_index()
-        df = pd.DataFrame({'TollFreeNumber': path_metrics['TollFreeNumber'],
-                           'date': path_metrics['date'],
-                           'avg_duration': path_metrics['session_duration']['mean'],
-                           'avg_previous_duration': path_metrics['previous_duration']['mean'],
-                           'avg_days_since_last_call': path_metrics['days_since_last_call']['mean'],
-                           'count': path_metrics['count']['sum']})
+        if self._use_tables():
+            df = self._callback_metrics_from_aggregates()
+        else:
+            df = self._callback_metrics()
 
         df.sort_values(by='date', inplace=True)
         grpd = df.groupby(['TollFreeNumber'])
@@ -249,7 +330,57 @@ class Flow(SankeyFlow):
                                hue='TollFreeNumber',
                                row=2, col=2)
         fig = self._fig_layout(fig)
-        return fig
+        return self._set_title(fig, self._sampling_error_note(df['count']) if self._is_sampled() else None)
+
+    def _callback_metrics_from_aggregates(self) -> pd.DataFrame:
+        """ Same output as _callback_metrics computed from the daily_callbacks aggregate
+        """
+        self._check_cancelled('callback_analysis')
+        metrics = self._aggregate('daily_callbacks').groupby(['date', 'TollFreeNumber']).sum().reset_index()
+        return pd.DataFrame({'TollFreeNumber': metrics['TollFreeNumber'],
+                             'date': metrics['date'],
+                             'avg_duration': metrics['session_duration_sum'] / metrics['session_duration_n'],
+                             'avg_previous_duration': (metrics['previous_duration_sum']
+                                                       / metrics['previous_duration_n']),
+                             'avg_days_since_last_call': (metrics['days_since_last_call_sum']
+                                                          / metrics['days_since_last_call_n']),
+                             'count': metrics['sessions']})
+
+    def _callback_metrics(self) -> pd.DataFrame:
+        """ Daily averages of the session metrics of callers split by TollFreeNumber, computed
+            from the session sample of the approximate view
+        """
+        if hasattr(self, '_data') == False or self._data is None:
+            self._data = self._approximate_events(self.start_date, self.end_date)
+
+        self._check_cancelled('callback_analysis')
+        df = self._data.copy()
+        session_df = df.groupby(['user_id', 'date', 'TollFreeNumber']).agg({'session_duration': ['mean'],
+                                                                            'previous_duration': ['mean'],
+                                                                            'days_since_last_call': ['mean'],
+                                                                            'count': ['mean']},
+                                                                           as_index=False).reset_index()
+        session_df = pd.DataFrame({'user_id': session_df['user_id'],
+                                   'date': session_df['date'],
+                                   'TollFreeNumber': session_df['TollFreeNumber'],
+                                   'session_duration': session_df['session_duration']['mean'],
+                                   'previous_duration': session_df['previous_duration']['mean'],
+                                   'days_since_last_call': session_df['days_since_last_call']['mean'],
+                                   'count': session_df['count']['mean']
+                                   })
+        self._check_cancelled('callback_analysis path_metrics')
+        path_metrics = session_df.groupby(['date', 'TollFreeNumber']).agg({'session_duration': ['mean'],
+                                                                           'previous_duration': ['mean'],
+                                                                           'days_since_last_call': ['mean'],
+                                                                           'count': ['sum']},
+                                                                          as_index=False).reset_index()
+        df = pd.DataFrame({'TollFreeNumber': path_metrics['TollFreeNumber'],
+                           'date': path_metrics['date'],
+                           'avg_duration': path_metrics['session_duration']['mean'],
+                           'avg_previous_duration': path_metrics['previous_duration']['mean'],
+                           'avg_days_since_last_call': path_metrics['days_since_last_call']['mean'],
+                           'count': path_metrics['count']['sum']})
+        return df
 
     def top_paths_plot(self) -> None:
         """ Calculates the 10 most common user paths and plots their distinct
@@ -259,20 +390,54 @@ class Flow(SankeyFlow):
         average call duration
         """
         print("Creating top_paths_plot")
+        if self._use_tables():
+            df = self._top_paths_metrics_from_aggregates()
+        else:
+            df = self._top_paths_metrics()
+        df['avg_14_day_avg_duration'] = df['avg_duration'].rolling(14).mean()
+        df['avg_14_day_count'] = df['count'].rolling(14).mean()
+        fig = self.time_stats(df,
+                              'path_nickname',
+                              {'count': 1, 'avg_duration': 2})
+        fig = self._fig_layout(fig)
+        return self._set_title(fig, self._sampling_error_note(df['count']) if self._is_sampled() else None)
+
+    def _top_paths_metrics_from_aggregates(self) -> pd.DataFrame:
+        """ Same output as _top_paths_metrics computed from the daily_paths aggregate
+        """
+        self._check_cancelled('top_paths_plot')
+        paths = self._aggregate('daily_paths')
+        target_paths = paths.groupby('path_nickname')['events'].sum().nlargest(10).index
+        path_metrics = (paths[paths['path_nickname'].isin(target_paths)]
+                        .groupby(['path_nickname', 'date'])[['sessions', 'duration_sum', 'duration_n']].sum()
+                        .reset_index())
+        return pd.DataFrame({'path_nickname': path_metrics['path_nickname'],
+                             'date': path_metrics['date'],
+                             'avg_duration': path_metrics['duration_sum'] / path_metrics['duration_n'],
+                             'count': path_metrics['sessions']})
+
+    def _top_paths_metrics(self) -> pd.DataFrame:
+        """ Daily session count and average session duration of the 10 most common paths, computed
+            from the session sample of the approximate view
+        """
         if hasattr(self, '_data') == False or self._data is None:
-            self._data = self.create_user_sequence(self.start_date, self.end_date)
+            self._data = self._approximate_events(self.start_date, self.end_date)
 
+        self._check_cancelled('top_paths_plot')
         df = self._data.copy()
-        target_paths = df.value_counts(['path_nickname'])[:10].reset_index().path_nickname.to_list()
+        # count is 1 per event, or the sampling weight of the session in approximate mode
+        target_paths = df.groupby('path_nickname')['count'].sum().nlargest(10).index.to_list()
         df = df[df['path_nickname'].isin(target_paths)]
-        session_df = df.groupby(['user_id', 'date', 'path_nickname']).agg({'session_duration': ['mean']},
+        session_df = df.groupby(['user_id', 'date', 'path_nickname']).agg({'session_duration': ['mean'],
+                                                                           'count': ['mean']},
                                                                           as_index=False).reset_index()
         session_df = pd.DataFrame({'user_id': session_df['user_id'],
                                    'path_nickname': session_df['path_nickname'],
                                    'date': session_df['date'],
                                    'session_duration': session_df['session_duration']['mean'],
-                                   'count': [1] * len(session_df)
+                                   'count': session_df['count']['mean']
                                    })
+        self._check_cancelled('top_paths_plot path_metrics')
         path_metrics = session_df.groupby(['path_nickname', 'date']).agg(
             {'session_duration': ['mean'], 'count': ['sum']},
             as_index=False).reset_index()
@@ -280,13 +445,7 @@ class Flow(SankeyFlow):
                            'date': path_metrics['date'],
                            'avg_duration': path_metrics['session_duration']['mean'],
                            'count': path_metrics['count']['sum']})
-        df['avg_14_day_avg_duration'] = df['avg_duration'].rolling(14).mean()
-        df['avg_14_day_count'] = df['count'].rolling(14).mean()
-        fig = self.time_stats(df,
-                              'path_nickname',
-                              {'count': 1, 'avg_duration': 2})
-        fig = self._fig_layout(fig)
-        return fig
+        return df
 
     def distinct_sessionId_count_plot(self) -> None:
         """ Gets the count of unique sessionIds per day and
@@ -294,20 +453,72 @@ class Flow(SankeyFlow):
         :return: two plots containing unique sessionId count and the 14 day rolling average
         """
         print("Creating distinct_sessionId_count_plot")
-        if hasattr(self, 'master') == False:
-            self._get_master()
-
-        df = self.master.copy()
-        path_metrics = df.groupby(['date', 'FlowName']).agg({'count': ['sum']},
-                                                            as_index=False).reset_index()
-        df = pd.DataFrame({'FlowName': path_metrics['FlowName'],
-                           'date': path_metrics['date'],
-                           'count': path_metrics['count']['sum']})
+        title = None
+        if self._use_tables():
+            sessions = self._tables()['daily_sessions']
+            self._check_cancelled('distinct_sessionId_count_plot')
+            df = sessions[['FlowName', 'date', 'sessions']].rename(columns={'sessions': 'count'})
+        else:
+            self._check_cancelled('distinct_sessionId_count_plot')
+            if hasattr(self, 'master'):
+                df, title = self._distinct_sessionId_count_sketched()
+            else:
+                df, title = self._distinct_sessionId_count_sampled()
 
         df['avg_14_day_count'] = df['count'].rolling(14).mean()
         fig = self.time_stats(df, 'FlowName', {'count': 1}, (self.start_date, self.end_date))
         fig = self._fig_layout(fig)
-        return fig
+        return self._set_title(fig, title)
+
+    def _daily_session_sketches(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Builds one HyperLogLog sketch of user_id per date of self.master the first time it is called
+
+        :return: sorted dates and an array of registers with one row per date
+        """
+        if hasattr(self, '_session_sketches') == False:
+            start_time = time.time()
+            self._session_sketches = HyperLogLog.grouped(self.master['user_id'],
+                                                         self.master['date'],
+                                                         self.sketch_precision)
+            print(f"Daily session sketches created in {round(time.time() - start_time, 2)} seconds")
+        return self._session_sketches
+
+    def _distinct_sessionId_count_sketched(self) -> Tuple[pd.DataFrame, str]:
+        """ Estimates the distinct sessions of every day, and of the selected date range by
+            merging the daily sketches
+
+        :return: daily counts and a title containing the range estimate with its 95% error bound
+        """
+        dates, registers = self._daily_session_sketches()
+        df = pd.DataFrame({'FlowName': self._flow_name,
+                           'date': dates,
+                           'count': HyperLogLog.estimate(registers).round()})
+        in_range = ((df['date'] >= pd.Timestamp(self.start_date))
+                    & (df['date'] < pd.Timestamp(self.end_date))).to_numpy()
+        total = HyperLogLog.estimate(registers[in_range].max(axis=0, initial=0)[np.newaxis, :])[0]
+        error = 1.96 * HyperLogLog.relative_error_for(self.sketch_precision)
+        title = (f"Approximate: {total:,.0f} distinct sessions (±{error:.1%}, 95%) "
+                 f"from {self.start_date} to {self.end_date}")
+        return df, title
+
+    def _distinct_sessionId_count_sampled(self) -> Tuple[pd.DataFrame, str]:
+        """ Estimates the distinct sessions of every day, and of the selected date range, by summing
+            the weights of the sampled sessions
+
+        :return: daily counts and a title containing the range estimate with its 95% error bound
+        """
+        sessions = self._sampled_master().drop_duplicates('user_id')
+        daily = sessions.groupby('date')[['count', 'count_var']].sum().reset_index()
+        df = pd.DataFrame({'FlowName': self._flow_name,
+                           'date': pd.to_datetime(daily['date']),
+                           'count': daily['count'].round()})
+        in_range = ((df['date'] >= pd.Timestamp(self.start_date))
+                    & (df['date'] < pd.Timestamp(self.end_date))).to_numpy()
+        total, variance = daily['count'][in_range].sum(), daily['count_var'][in_range].sum()
+        error = 1.96 * np.sqrt(variance) / total if total > 0 else np.nan
+        title = (f"Approximate: {total:,.0f} distinct sessions (±{error:.1%}, 95%) "
+                 f"from {self.start_date} to {self.end_date}")
+        return df, title
 
     def _get_date(self,
                   date: Optional[Union[str, datetime.date]],
@@ -339,22 +550,84 @@ class Flow(SankeyFlow):
         return f"('{self._flow_name}')"
 
     @staticmethod
-    @anycache(cachedir=os.path.join(dir_path, 'data/anycache.my'))
-    def query_db(query: str, flow_name: str, start_date: str, end_date: str) -> pd.DataFrame:
-        """ Get source data from Bigquery
+    def _run_query(query: str, params: Tuple) -> pd.DataFrame:
+        """ Get source data from Bigquery, or from the query cache if the same query
+            was already run. Results for date ranges that include today expire after
+            query_cache.today_ttl seconds.
+
+        :param query: .sql that should be run
+        :param params: flow name, start date, end date, sample rate and minimum sessions per path
+            that should be inserted into query
+        :return: dataframe containing results of query
+        """
+        df = query_cache.get(query, params)
+        if df is not None:
+            print("Query loaded from cache")
+            return df
+
+        print("Starting Query")
+        df = client.query(query.format(*params)).to_dataframe()
+        includes_today = params[2] >= datetime.date.today().strftime('%Y-%m-%d')
+        query_cache.set(query, params, df, ttl=query_cache.today_ttl if includes_today else None)
+        return df
+
+    @staticmethod
+    def submit_query(query: str,
+                     flow_name: str,
+                     start_date: str,
+                     end_date: str,
+                     sample_rate: float = 1,
+                     min_stratum_sessions: int = 0) -> Future:
+        """ Schedules a query on the shared QueryScheduler without waiting for it.
+            Identical queries that are already running share the same future.
+
+        :param query: .sql that should be run
+        :param flow_name: name of flow or flows that should be inserted into query
+        :param start_date: date that should be inserted into query
+        :param end_date: date that should be inserted into query
+        :param sample_rate: fraction of sessions kept by queries that sample, 1 keeps every session
+        :param min_stratum_sessions: sessions kept from every path when sample_rate keeps fewer
+        :return: future holding the dataframe containing results of query
+        """
+        params = (flow_name, start_date, end_date, sample_rate, min_stratum_sessions)
+        return QueryScheduler.shared().submit(query_cache.key(query, params), Flow._run_query, query, params)
+
+    @staticmethod
+    def query_db(query: str,
+                 flow_name: str,
+                 start_date: str,
+                 end_date: str,
+                 sample_rate: float = 1,
+                 min_stratum_sessions: int = 0) -> pd.DataFrame:
+        """ Get source data from Bigquery and wait for the result
 
         :param query: .sql that should be run
         :param flow_name: name of flow or flows that should be inserted into query
         :param start_date: date that should be inserted into query
         :param end_date: date that should be inserted into query
+        :param sample_rate: fraction of sessions kept by queries that sample, 1 keeps every session
+        :param min_stratum_sessions: sessions kept from every path when sample_rate keeps fewer
         :return: dataframe containing results of query
         """
-        print("Starting Query")
+        # the result may be shared with other callers, a shallow copy lets each one add columns
+        return Flow.submit_query(query, flow_name, start_date, end_date,
+                                 sample_rate, min_stratum_sessions).result().copy(deep=False)
 
-        query = query.format(flow_name,
-                             start_date,
-                             end_date)
-        return client.query(query).to_dataframe()
+    def fetch_queries(self, filenames: List[str]) -> Dict[str, pd.DataFrame]:
+        """ Runs several queries from the SQLs folder for this flow and date range in parallel
+
+        Example: flow.fetch_queries(['top_paths.sql', 'distinct_sessionId_count.sql', 'user_sequence.sql'])
+
+        :param filenames: names of the .sql files that should be run
+        :return: dictionary of filename to dataframe containing results of query
+        """
+        start_date, end_date = self._get_date(None, self.start_date), self._get_date(None, self.end_date)
+        futures = {filename: self.submit_query(Utilities.open_sql(self.dir_path, filename),
+                                               self._formatted_flow_name(),
+                                               start_date.strftime('%Y-%m-%d'),
+                                               end_date.strftime('%Y-%m-%d'))
+                   for filename in filenames}
+        return {filename: future.result().copy(deep=False) for filename, future in futures.items()}
 
     def _get_master(self):
         """ Get the global dataset that will be used for all calculations inside
@@ -363,11 +636,13 @@ class Flow(SankeyFlow):
         :return: None
         """
         start_time = time.time()
-        start_date, end_date = self._get_date(None, self.start_date), self._get_date(None, self.end_date)
         query = Utilities.open_sql(self.dir_path, 'user_sequence.sql')
+        # the sample of the approximate view is not needed once every event is loaded
+        self.__dict__.pop('_sample', None)
 
         # Temp fix for testing because my credentials are not working
         cache = False
+        stored = self._has_aggregates() and self.store.has_sequence(self._flow_name, self._aggregates_version)
         if cache:
             df = pd.read_csv(os.path.join(self.dir_path,
                                           'data/manually_loaded_data',
@@ -377,13 +652,163 @@ class Flow(SankeyFlow):
             df['time_event'] = df.time_event.apply(lambda x: pytz.utc.localize(x))
             df['date'] = df.time_event.dt.date
             self.master = df
+        elif stored:
+            # events materialized by the nightly batch, no query needed
+            self.master = self.session_sequence().to_events()
         else:
-            self.master = self.query_db(query,
-                                        self._formatted_flow_name(),
-                                        start_date.strftime('%Y-%m-%d'),
-                                        end_date.strftime('%Y-%m-%d'))
+            self.master = self.query_db(query, *self._master_params())
+        self._classify_numbers()
         print(f"Master Dataset Gathered in {round(time.time() - start_time, 0)} seconds")
 
+    def _classify_numbers(self) -> None:
+        """ Classifies every CallingNumber in self.master once and stores the compact
+            category code in 'number_category'. The TollFreeNumber column and the
+            mask used by the tollfree toggle are derived from those codes.
+
+        :return: None
+        """
+        start_time = time.time()
+        self._label_numbers(self.master)
+        self._nontollfree_mask = (self.master['TollFreeNumber'] == 'NonTollFree').to_numpy()
+        print(f"Calling numbers classified in {round(time.time() - start_time, 2)} seconds")
+
+    def _label_numbers(self, df: pd.DataFrame) -> None:
+        """ Adds the number_category and TollFreeNumber columns to an event level dataframe
+        """
+        codes = self.number_classifier.classify(df['CallingNumber'])
+        df['number_category'] = codes
+        # sessions without a usable calling number are neither TollFree nor NonTollFree
+        unknown = codes.isin([self.number_classifier.missing_code, self.number_classifier.code('restricted')])
+        tollfree = (codes == self.number_classifier.code('toll_free')).to_numpy(dtype=np.int8)
+        labels = np.array(['NonTollFree', 'TollFree', None], dtype=object)
+        df['TollFreeNumber'] = labels[np.where(unknown, 2, tollfree)]
+
+    def session_index(self) -> SessionIndex:
+        """ Builds the SessionIndex of the flow's SessionSequence the first time it is requested,
+            so a materialized flow builds it from the memory-mapped sequence without a master
+
+        :return: index from path, event and edge to sessions
+        """
+        sequence = self.session_sequence()
+        if hasattr(self, '_session_index') == False or self._session_index.sequence is not sequence:
+            start_time = time.time()
+            self._session_index = SessionIndex(sequence)
+            print(f"SessionIndex created in {round(time.time() - start_time, 2)} seconds")
+        return self._session_index
+
+    def _selected_sessions(self, sessions) -> pd.DataFrame:
+        """ Restricts sessions to this instance's date range and tollfree setting and
+            returns their metrics
+        """
+        index = self.session_index()
+        sessions = sessions & index.date_range(self.start_date, self.end_date)
+        if not self.include_tollfree:
+            sessions = sessions & index.tollfree('NonTollFree')
+        return index.metrics(sessions)
+
+    def link_sessions(self, source: str, target: str, path_nickname: str = None) -> pd.DataFrame:
+        """ Returns the sessions that went from source to target, for example after clicking a Sankey link
+
+        :param source: event_name of the link source
+        :param target: event_name of the link target
+        :param path_nickname: if provided only sessions on this path are returned
+        :return: dataframe with one row of metrics per session
+        """
+        index = self.session_index()
+        sessions = index.edge(source, target)
+        if path_nickname is not None:
+            sessions = sessions & index.path(path_nickname)
+        return self._selected_sessions(sessions)
+
+    def path_sessions(self, path_nickname: str, callbacks_only: bool = False) -> pd.DataFrame:
+        """ Returns the sessions that followed a path, replaces path_session_ids.sql
+
+        :param path_nickname: path such as '3-Path_Freq_Rank'
+        :param callbacks_only: only return sessions from numbers that called before
+        :return: dataframe with one row of metrics per session
+        """
+        index = self.session_index()
+        sessions = index.path(path_nickname)
+        if callbacks_only:
+            sessions = sessions & index.callbacks()
+        return self._selected_sessions(sessions)
+
+    def session_sequence(self) -> SessionSequence:
+        """ Returns the events of the flow in SessionSequence form, read from the aggregate
+            store when the flow was materialized and built from self.master otherwise
+
+        :return: sequence of every session of the flow
+        """
+        # drops the cached sequence when the store published a new version
+        aggregated = self._has_aggregates()
+        if hasattr(self, '_session_sequence') == False:
+            start_time = time.time()
+            # memory-mapped from the store, shared with the other server processes
+            sequence = self.store.load_sequence(self._flow_name, self._aggregates_version) if aggregated else None
+            if sequence is None:
+                if hasattr(self, 'master') == False:
+                    self._get_master()
+                sequence = SessionSequence.from_events(self.master)
+            self._session_sequence = sequence
+            print(f"SessionSequence of {len(sequence)} sessions and {sequence.n_events} events "
+                  f"using {sequence.nbytes} bytes ready in {round(time.time() - start_time, 2)} seconds")
+        return self._session_sequence
+
+    def funnel_engine(self) -> Funnel:
+        """ Builds the Funnel of the flow's SessionSequence the first time it is requested
+        """
+        sequence = self.session_sequence()
+        if hasattr(self, '_funnel_engine') == False or self._funnel_engine.sequence is not sequence:
+            self._funnel_engine = Funnel(sequence)
+        return self._funnel_engine
+
+    def funnel(self,
+               steps: List[str] = None,
+               path_nickname: str = None,
+               strict: bool = False) -> pd.DataFrame:
+        """ Computes the funnel of the sessions inside this instance's date range and tollfree setting
+
+        :param steps: ordered list of ActionIds (event_name values), defaults to the events of path_nickname
+        :param path_nickname: path whose events are used as steps, defaults to self.path_highlight
+        :param strict: if True every step after the first must directly follow the previous step
+        :return: dataframe with sessions, conversion, drop_off and time_to_next percentiles per step
+        """
+        engine = self.funnel_engine()
+        if steps is None:
+            steps = engine.path_steps(path_nickname if path_nickname is not None else self.path_highlight)
+        mask = engine.session_mask(self.start_date, self.end_date, None if self.include_tollfree else 'NonTollFree')
+        return engine.compute(steps, mask, strict)
+
+    def top_path_funnels(self, k: int = 5, strict: bool = False) -> Dict[str, pd.DataFrame]:
+        """ Computes the funnel of each of the k most followed paths in the current date range
+
+        :param k: number of paths
+        :param strict: if True every step after the first must directly follow the previous step
+        :return: dictionary of path_nickname to funnel dataframe
+        """
+        engine = self.funnel_engine()
+        mask = engine.session_mask(self.start_date, self.end_date, None if self.include_tollfree else 'NonTollFree')
+        return {path: engine.compute(engine.path_steps(path), mask, strict) for path in engine.top_paths(k, mask)}
+
+    def funnel_plot(self,
+                    steps: List[str] = None,
+                    path_nickname: str = None,
+                    strict: bool = False) -> go.Figure:
+        """ Plots the funnel returned by Flow.funnel with the median time to the next step on hover
+
+        :return: plotly funnel figure
+        """
+        df = self.funnel(steps, path_nickname, strict)
+        fig = go.Figure(go.Funnel(y=[f"{row.step}. {row.event_name}" for row in df.itertuples()],
+                                  x=df['sessions'],
+                                  textinfo='value+percent initial+percent previous',
+                                  customdata=df[['drop_off', 'time_to_next_p50', 'time_to_next_p90']].values,
+                                  hovertemplate='%{x} sessions, %{customdata[0]} dropped off<br />'
+                                                'median %{customdata[1]} seconds to the next step '
+                                                '(90th percentile %{customdata[2]})<extra></extra>'))
+        fig.update_layout(title=f"{self._flow_name} funnel From {self.start_date} to {self.end_date}")
+        return fig
+
     def create_user_sequence(self,
                              start_date: datetime.date = None,
                              end_date: datetime.date = None) -> pd.DataFrame:
@@ -396,15 +821,25 @@ class Flow(SankeyFlow):
         if hasattr(self, 'master') == False:
             self._get_master()
 
-        df = self.master.copy()
+        keep = np.ones(len(self.master), dtype=bool)
         if start_date is not None:
-            df = df[df['time_event'] > self._to_datetime(start_date)]
+            keep &= (self.master['time_event'] > self._to_datetime(start_date)).to_numpy()
         if end_date is not None:
-            df = df[df['time_event'] < self._to_datetime(end_date)]
-        if not self.include_tollfree:
-            length = len(df)
-            df = df[df['TollFreeNumber'] == 'NonTollFree']
-            print(f"Removing TollFreeNumbers: length before {length} length now {len(df)}")
+            keep &= (self.master['time_event'] < self._to_datetime(end_date)).to_numpy()
+        self._sequence = self.master[keep]
+        self._sequence_nontollfree = self._nontollfree_mask[keep]
+        return self._apply_tollfree_toggle()
+
+    def _apply_tollfree_toggle(self) -> pd.DataFrame:
+        """ Applies the precomputed NonTollFree mask to the date filtered sequence
+            when include_tollfree is False
+
+        :return: pandas dataframe with data
+        """
+        if self.include_tollfree:
+            return self._sequence
+        df = self._sequence[self._sequence_nontollfree]
+        print(f"Removing TollFreeNumbers: length before {len(self._sequence)} length now {len(df)}")
         return df
 
     @staticmethod
@@ -435,10 +870,135 @@ class Flow(SankeyFlow):
         :return: SanKey figure
         """
         start_date, end_date = self._get_date(start_date, self.start_date), self._get_date(end_date, self.end_date)
+        title = f"{self._flow_name} From {start_date} to {end_date}" if title is None else title
+        if data is None and self._use_tables():
+            note = self._materialized_note(end_date)
+            return self._sankey_plot_from_aggregates(start_date, end_date,
+                                                     title if note is None else f"{title} ({note})")
         if data is not None:
-            self._data = data
+            self._data = self._sample_sessions(data) if self.approximate else data
         else:
-            self._data = self.create_user_sequence(start_date, end_date)
-        title = f"{self._flow_name} From {start_date} to {end_date}" if title is None else title
+            # only the approximate view of a flow that is not materialized gets here
+            self._data = self._approximate_events(start_date, end_date)
+        if self.approximate:
+            title = f"{title} (approximate, {self.sample_rate:.0%} session sample)"
+        self._check_cancelled('sankey plot')
         fig = self.plot(threshold, title)
         return fig
+
+    def _sample_sessions(self, df: pd.DataFrame) -> pd.DataFrame:
+        """ Deterministic session level sample stratified by path_nickname. Every session is
+            kept or dropped with all of its events, depending only on the hash of its user_id.
+            Paths with few sessions are sampled at a higher rate so every path stays visible.
+            The count column of kept events is set to the session's weight (1 / rate), and
+            count_var holds the variance that weight adds to any count summed from it.
+
+        :param df: event level data
+        :return: sampled event level data
+        """
+        start_time = time.time()
+        sessions = df[['user_id', 'path_nickname']].drop_duplicates('user_id')
+        stratum_size = sessions.groupby(sessions['path_nickname'].fillna(''))['user_id'].transform('size')
+        rate = np.minimum(1.0, np.maximum(self.sample_rate, self.min_stratum_sessions / stratum_size.to_numpy()))
+        position = pd.util.hash_array(sessions['user_id'].to_numpy(dtype=object)) / 2.0 ** 64
+        kept = position < rate
+        weights = pd.Series(1 / rate[kept], index=sessions['user_id'].to_numpy()[kept])
+
+        sample = df[df['user_id'].isin(weights.index)].copy()
+        weight = sample['user_id'].map(weights)
+        sample['count'] = sample['count'] * weight
+        sample['count_var'] = sample['count'] * (weight - 1)
+        print(f"Sampled {len(weights)} of {len(sessions)} sessions in {round(time.time() - start_time, 2)} seconds")
+        return sample
+
+    def _is_sampled(self) -> bool:
+        # after an approximate view _data still holds the sample until the next approximate build
+        return (self.approximate and hasattr(self, '_data') and self._data is not None
+                and 'count_var' in self._data.columns)
+
+    def _sampling_error_note(self, counts: pd.Series) -> str:
+        """ Title describing the 95% error of a typical count in a figure built from a sample
+        """
+        typical = counts[counts > 0].median()
+        error = 1.96 * np.sqrt((1 / self.sample_rate - 1) / typical) if typical > 0 else np.nan
+        return f"Approximate: {self.sample_rate:.0%} session sample, typical count ±{error:.0%} (95%)"
+
+    def approximate_available(self, min_events: int) -> bool:
+        """ Returns True if the flow is large enough for an approximate first view to be worth it.
+            A flow whose events are not loaded yet always gets one, since its session sample is
+            queried much faster than the full events.
+
+        :param min_events: minimum number of events in self.master
+        """
+        if self._has_aggregates():
+            return False
+        if hasattr(self, 'master') == False:
+            return True
+        return len(self.master) >= min_events
+
+    def _master_params(self) -> Tuple[str, str, str]:
+        start_date, end_date = self._get_date(None, self.start_date), self._get_date(None, self.end_date)
+        return self._formatted_flow_name(), start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+
+    def _sampled_master(self) -> pd.DataFrame:
+        """ Queries the deterministic session sample of user_sequence.sql the first time it is called.
+            The full query is started at the same time, so self.master is loading while the
+            approximate view is built. The count column of every event is the weight of its
+            session (1 / rate), and count_var the variance that weight adds to any count summed from it.
+
+        :return: sampled event level data
+        """
+        if hasattr(self, '_sample') == False:
+            start_time = time.time()
+            query = Utilities.open_sql(self.dir_path, 'user_sequence.sql')
+            self.submit_query(query, *self._master_params())
+            sample = self.query_db(query, *self._master_params(), self.sample_rate, self.min_stratum_sessions)
+            self._label_numbers(sample)
+            weight = sample['sample_weight'].astype(np.float64)
+            sample['count'] = weight
+            sample['count_var'] = weight * (weight - 1)
+            self._sample = sample
+            print(f"Session sample of {len(sample)} events gathered in {round(time.time() - start_time, 0)} seconds")
+        return self._sample
+
+    def _approximate_events(self, start_date: datetime.date, end_date: datetime.date) -> pd.DataFrame:
+        """ Sampled events of the date range and tollfree setting for the approximate view, sampled
+            from self.master when it is loaded and queried as a sample otherwise
+        """
+        if hasattr(self, 'master'):
+            return self._sample_sessions(self.create_user_sequence(start_date, end_date))
+        df = self._sampled_master()
+        keep = ((df['time_event'] > self._to_datetime(start_date))
+                & (df['time_event'] < self._to_datetime(end_date))).to_numpy()
+        if not self.include_tollfree:
+            keep = keep & (df['TollFreeNumber'] == 'NonTollFree').to_numpy()
+        return df[keep]
+
+    def _sankey_plot_from_aggregates(self,
+                                     start_date: datetime.date,
+                                     end_date: datetime.date,
+                                     title: str) -> go.Figure:
+        """ Same figure as SankeyFlow.plot built from the daily_edges and daily_node_ranks aggregates
+
+        :param start_date: first date included
+        :param end_date: first date excluded
+        :param title: chart title
+        :return: SanKey figure
+        """
+        start_time = time.time()
+        edges = AggregateStore.filter(self._tables()['daily_edges'], start_date, end_date, self.include_tollfree)
+        node_ranks = AggregateStore.filter(self._tables()['daily_node_ranks'],
+                                           start_date, end_date, self.include_tollfree)
+        self.title = title
+        self.labelList, self.colorList, self.sourceTargetDf = self.build_sourceTargetDf_from_aggregates(edges,
+                                                                                                        node_ranks)
+        self._check_cancelled('genSankey')
+        fig = self.genSankey(
+            self.sourceTargetDf,
+            self.labelList,
+            self.colorList,
+            self.path_highlight,
+            threshold=self._threshold,
+            title=self.title)
+        print(f"Finished in {round((time.time() - start_time) * 60, 2)}")
+        return fig
@@ -66,25 +66,8 @@ AND EXTRACT(DATE FROM TimeStamp) BETWEEN '{1}' AND '{2}'
 
 ),
 
-tollfreenumbers AS (
-SELECT '%800%' areacode, '.' matchkey
-UNION ALL
-SELECT '%888%' areacode, '.' matchkey
-UNION ALL
-SELECT '%877%' areacode, '.' matchkey
-UNION ALL
-SELECT '%866%' areacode, '.' matchkey
-UNION ALL
-SELECT '%855%' areacode, '.' matchkey
-UNION ALL
-SELECT '%844%' areacode, '.' matchkey
-UNION ALL
-SELECT '%833%' areacode, '.' matchkey
-),
-
 callback_subset AS (
 SELECT DISTINCT *,
-        CASE WHEN LEFT(CallingNumber, 6) LIKE tollfreenumbers.areacode THEN 1 ELSE 0 END AS TollFreeNumber,
         RANK() OVER(PARTITION BY CallingNumber ORDER BY TimeStamp) rank,
         TIMESTAMP_DIFF(TimeStamp, LAG(TimeStamp) OVER(PARTITION BY CallingNumber ORDER BY TimeStamp), DAY) days_since_last_call,
         LAG(session_duration) OVER(PARTITION BY CallingNumber ORDER BY TimeStamp) previous_duration
@@ -93,14 +76,12 @@ FROM (
                 CallingNumber,
                 SessionId,
                 MIN(Timestamp) TimeStamp,
-                TIMESTAMP_DIFF(MAX(TimeStamp), MIN(TimeStamp), SECOND) session_duration,
-                '.' matchkey
+                TIMESTAMP_DIFF(MAX(TimeStamp), MIN(TimeStamp), SECOND) session_duration
         FROM filtered f
         WHERE CallingNumber != 'Restricted'
         AND CallingNumber IS NOT NULL
         GROUP BY CallingNumber, SessionId
      )
-INNER JOIN tollfreenumbers USING(matchkey)
 ),
 
 callbacks AS (
@@ -112,8 +93,7 @@ FROM (
       SELECT CallingNumber,
              SessionId,
              ANY_VALUE(TimeStamp) TimeStamp,
-             ANY_VALUE(session_duration) session_duration,
-             CASE WHEN SUM(TollFreeNumber) > 0 THEN 'TollFree' ELSE 'NonTollFree' END TollFreeNumber
+             ANY_VALUE(session_duration) session_duration
       FROM callback_subset
       GROUP BY CallingNumber, SessionId
       )
@@ -182,9 +162,12 @@ SELECT
        cb.days_since_last_call,
        cb.session_duration,
        cb.previous_duration,
-       cb.TollFreeNumber AS TollFreeNumber
+       1 / LEAST(1, GREATEST({3}, {4} / pr.count)) AS sample_weight
 FROM metric_prep m
 INNER JOIN Session_paths s USING(SessionId)
 INNER JOIN path_ranks pr USING(Path)
 LEFT JOIN callbacks cb USING(SessionId)
+-- deterministic session sample at rate {3}, paths with few sessions keep at least {4} of them.
+-- A rate of 1 keeps every session
+WHERE ABS(MOD(FARM_FINGERPRINT(CAST(m.SessionId AS STRING)), 1000000)) < 1000000 * LEAST(1, GREATEST({3}, {4} / pr.count))
 ORDER BY user_id, time_event
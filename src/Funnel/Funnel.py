@@ -0,0 +1,115 @@
+import datetime
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from src import SessionSequence
+
+
+class Funnel:
+    """ Step by step funnel over the sessions of a SessionSequence.
+
+        A funnel of k steps is k vectorized passes over the flat event arrays:
+        each pass finds, for every session still in the funnel, the first event
+        matching the step after the position where the previous step was reached.
+    """
+    percentiles = [50, 90, 95]
+
+    def __init__(self, sequence: SessionSequence) -> None:
+        """
+        :param sequence: sessions of a flow, see Flow.session_sequence
+        """
+        self.sequence = sequence
+        self.session = sequence.session_ids()
+        self.event_codes = sequence.event_codes
+        self.event_names = sequence.vocabularies['event_name']
+        self.offsets = sequence.offsets[:-1]
+        self.ends = sequence.offsets[1:]
+
+    def session_mask(self,
+                     start_date: datetime.date = None,
+                     end_date: datetime.date = None,
+                     tollfree: str = None) -> np.ndarray:
+        """ Selects the sessions that start on or after start_date, before end_date and
+            optionally have a given TollFreeNumber label
+
+        :return: boolean array with one entry per session
+        """
+        return self.sequence.session_mask(start_date, end_date, tollfree)
+
+    def path_steps(self, path_nickname: str) -> List[str]:
+        """ Returns the ordered events of a path such as '1-Path_Freq_Rank'
+        """
+        sessions = np.flatnonzero(self.sequence.column('path_nickname') == path_nickname)
+        if len(sessions) == 0:
+            raise Exception(f"No sessions found on path {path_nickname}")
+        first = sessions[0]
+        codes = self.event_codes[self.offsets[first]:self.ends[first]]
+        return self.event_names.take(codes).tolist()
+
+    def top_paths(self, k: int, session_mask: np.ndarray = None) -> List[str]:
+        """ Returns the k paths followed by the most sessions
+        """
+        return [path for path, _ in self.sequence.sessions_per_path(session_mask)[:k]]
+
+    def compute(self,
+                steps: List[str],
+                session_mask: np.ndarray = None,
+                strict: bool = False) -> pd.DataFrame:
+        """ Computes reach, conversion, drop off and time to next step of each funnel step
+
+        :param steps: ordered event_name values (ActionIds) making up the funnel
+        :param session_mask: sessions included in the funnel, all sessions if None
+        :param strict: if True every step after the first must be the event directly after the previous step
+        :return: dataframe with one row per step
+        """
+        n_sessions = len(self.offsets)
+        reached = np.ones(n_sessions, dtype=bool) if session_mask is None else session_mask.copy()
+        total = int(reached.sum())
+        # position of the event where the session reached the previous step
+        position = self.offsets - 1
+        rows = []
+        for step, event_name in enumerate(steps, 1):
+            # -1 when no event has this name, no event code is negative
+            code = self.event_names.find(event_name)
+            if strict and step > 1:
+                candidate = position + 1
+                valid = reached & (candidate < self.ends)
+                valid[valid] = self.event_codes[candidate[valid]] == code
+                new_position = np.where(valid, candidate, -1)
+            else:
+                event_index = np.flatnonzero(self.event_codes == code)
+                event_session = self.session[event_index]
+                keep = reached[event_session] & (event_index > position[event_session])
+                event_index, event_session = event_index[keep], event_session[keep]
+                # event_index is sorted so the first entry of every session is its earliest match
+                first = (np.flatnonzero(np.r_[True, event_session[1:] != event_session[:-1]])
+                         if len(event_session) else np.array([], dtype=np.int64))
+                valid = np.zeros(n_sessions, dtype=bool)
+                valid[event_session[first]] = True
+                new_position = np.full(n_sessions, -1)
+                new_position[event_session[first]] = event_index[first]
+
+            sessions = int(valid.sum())
+            previous = rows[-1]['sessions'] if rows else total
+            if rows:
+                milliseconds = (self.sequence.time_offsets[new_position[valid]]
+                                - self.sequence.time_offsets[position[valid]])
+                durations = milliseconds / 1000
+                for p, value in zip(self.percentiles,
+                                    np.percentile(durations, self.percentiles) if sessions else [np.nan] * 3):
+                    rows[-1][f"time_to_next_p{p}"] = value
+            rows.append({'step': step,
+                         'event_name': event_name,
+                         'sessions': sessions,
+                         'conversion': sessions / previous if previous else np.nan,
+                         'conversion_from_start': sessions / total if total else np.nan,
+                         'drop_off': previous - sessions})
+            reached, position = valid, new_position
+
+        df = pd.DataFrame(rows)
+        for p in self.percentiles:
+            if f"time_to_next_p{p}" not in df.columns:
+                df[f"time_to_next_p{p}"] = np.nan
+        return df
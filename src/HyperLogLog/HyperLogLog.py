@@ -0,0 +1,103 @@
+from typing import Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class HyperLogLog:
+    """ HyperLogLog sketch of the number of distinct values.
+
+        Each value is hashed to 64 bits, the first p bits select one of 2**p
+        registers and the register keeps the highest rank (position of the first
+        set bit) seen in the remaining bits. Sketches over the same p are merged
+        with an element-wise maximum, so daily sketches can be combined into the
+        distinct count of any date range.
+    """
+
+    def __init__(self, p: int = 12, registers: np.ndarray = None) -> None:
+        """
+        :param p: number of index bits, the sketch uses 2**p one byte registers
+        :param registers: existing registers, a new empty sketch is created if None
+        """
+        if p < 4 or p > 18:
+            raise Exception(f"p must be between 4 and 18, received {p}")
+        self.p = p
+        self.registers = registers if registers is not None else np.zeros(1 << p, dtype=np.uint8)
+
+    @property
+    def relative_error(self) -> float:
+        """ Standard error of the estimate relative to the true count
+        """
+        return self.relative_error_for(self.p)
+
+    @staticmethod
+    def relative_error_for(p: int) -> float:
+        return 1.04 / np.sqrt(1 << p)
+
+    @staticmethod
+    def _register_ranks(values: Iterable, p: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Hashes values and returns the register index and rank of each one
+        """
+        hashes = pd.util.hash_array(np.asarray(values, dtype=object))
+        index = (hashes >> np.uint64(64 - p)).astype(np.int64)
+        rest = hashes & np.uint64((1 << (64 - p)) - 1)
+        # bit length computed from two 32 bit halves, which float64 represents exactly
+        high = (rest >> np.uint64(32)).astype(np.float64)
+        low = (rest & np.uint64(0xFFFFFFFF)).astype(np.float64)
+        with np.errstate(divide='ignore'):
+            bit_length = np.where(high > 0, np.floor(np.log2(high)) + 33,
+                                  np.where(low > 0, np.floor(np.log2(low)) + 1, 0))
+        ranks = (64 - p) - bit_length + 1
+        return index, ranks.astype(np.uint8)
+
+    def add(self, values: Iterable) -> None:
+        """ Adds values to the sketch
+        """
+        index, ranks = self._register_ranks(values, self.p)
+        np.maximum.at(self.registers, index, ranks)
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        """ Returns the sketch of the union of both sketches
+        """
+        if other.p != self.p:
+            raise Exception(f"Cannot merge sketches with p {self.p} and {other.p}")
+        return HyperLogLog(self.p, np.maximum(self.registers, other.registers))
+
+    def count(self) -> float:
+        """ Returns the estimated number of distinct values added
+        """
+        return float(self.estimate(self.registers[np.newaxis, :])[0])
+
+    @staticmethod
+    def estimate(registers: np.ndarray) -> np.ndarray:
+        """ Estimates the distinct count of every row of a 2D array of registers
+
+        :param registers: array of shape (sketches, 2**p)
+        :return: estimated distinct count of each sketch
+        """
+        m = registers.shape[1]
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)), axis=1)
+        zeros = np.sum(registers == 0, axis=1)
+        with np.errstate(divide='ignore'):
+            linear = m * np.log(m / np.maximum(zeros, 1))
+        # linear counting is more accurate while many registers are still empty
+        return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+    @classmethod
+    def grouped(cls, values: pd.Series, groups: pd.Series, p: int = 12) -> Tuple[np.ndarray, np.ndarray]:
+        """ Builds one sketch per group in a single vectorized pass
+
+        :param values: values that are counted, for example user_id
+        :param groups: group of each value, for example date
+        :return: sorted group labels and an array of registers with one row per label
+        """
+        codes, labels = pd.factorize(groups, sort=True)
+        index, ranks = cls._register_ranks(values, p)
+        m = 1 << p
+        registers = np.zeros((len(labels), m), dtype=np.uint8)
+        valid = codes >= 0
+        maxima = pd.Series(ranks[valid]).groupby(codes[valid].astype(np.int64) * m + index[valid]).max()
+        cells = maxima.index.to_numpy()
+        registers[cells // m, cells % m] = maxima.to_numpy()
+        return np.asarray(labels), registers
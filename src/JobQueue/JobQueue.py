@@ -0,0 +1,230 @@
+import os
+import time
+import fcntl
+import pickle
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Tuple
+from urllib.parse import quote
+
+
+class JobCancelled(Exception):
+    """ Raised inside a job when a newer job from the same client has been submitted
+    """
+
+
+class CancelToken:
+    """ Handed to every job so long running code can stop at stage boundaries once
+        the job is no longer the latest one for its client
+    """
+
+    def __init__(self, queue: 'JobQueue', client_id: Hashable, generation: int) -> None:
+        self._queue = queue
+        self.client_id = client_id
+        self.generation = generation
+        self.published = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._queue.latest_generation(self.client_id) != self.generation
+
+    def check(self, stage: str = None) -> None:
+        """ Raises JobCancelled if a newer job exists for the same client
+
+        :param stage: name of the stage about to start, used for logging
+        """
+        if self.cancelled:
+            print(f"Job {self.client_id}:{self.generation} cancelled before {stage}")
+            raise JobCancelled(stage)
+
+    def publish(self, result: Any) -> None:
+        """ Makes an intermediate result, such as an approximate view, available to
+            pollers while the job keeps running
+        """
+        self._queue._publish(self, result)
+
+
+class JobQueue:
+    """ Background queue where only the latest job of each client matters.
+
+        Every submit for a client increments its generation. Older jobs that have
+        not started are dropped, and running ones see their CancelToken report
+        cancelled so they stop at their next check. Callers poll status with the
+        generation returned by submit, and partial for results a running job
+        published before finishing.
+
+        Generations, partial and final results are files in one directory per client
+        under state_dir, so a job submitted to one server process can be polled and
+        cancelled from any other process sharing state_dir. The generation file is
+        incremented under an exclusive file lock and results are written to a
+        temporary file that is renamed into place, so pollers only ever read complete
+        results. Clients that have not submitted or polled for expire_after seconds
+        are removed with their results.
+    """
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    generation_file = 'generation'
+    lock_file = '.lock'
+
+    def __init__(self, state_dir: str = None, max_workers: int = 2, expire_after: float = 300) -> None:
+        """
+        :param state_dir: directory shared by every process polling the jobs, defaults to data/ in this module
+        :param max_workers: number of jobs this process can run at the same time
+        :param expire_after: seconds a client's jobs are kept after it last submitted or polled
+        """
+        self.state_dir = state_dir if state_dir is not None else os.path.join(self.dir_path, 'data')
+        self.expire_after = expire_after
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        # jobs started by this process, kept to drop them before they start when they are replaced
+        self._futures: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def _client_dir(self, client_id: Hashable) -> str:
+        return os.path.join(self.state_dir, quote(str(client_id), safe=''))
+
+    def _path(self, client_id: Hashable, name: str) -> str:
+        return os.path.join(self._client_dir(client_id), name)
+
+    @contextmanager
+    def _file_lock(self, client_id: Hashable) -> Iterator[None]:
+        """ Holds an exclusive lock on the client's directory across processes
+        """
+        with open(self._path(client_id, self.lock_file), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _atomic_write(self, path: str, payload: bytes) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _read_pickle(self, path: str) -> Optional[Any]:
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def latest_generation(self, client_id: Hashable) -> int:
+        try:
+            with open(self._path(client_id, self.generation_file)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def submit(self, client_id: Hashable, fn: Callable, *args: Any) -> int:
+        """ Schedules fn(token, *args) as the latest job of client_id
+
+        :param client_id: identifies the browser session that requested the job
+        :param fn: function to run, it receives a CancelToken as first argument
+        :param args: arguments passed to fn after the token
+        :return: generation of the new job
+        """
+        self._expire()
+        os.makedirs(self._client_dir(client_id), exist_ok=True)
+        with self._file_lock(client_id):
+            generation = self.latest_generation(client_id) + 1
+            self._atomic_write(self._path(client_id, self.generation_file), str(generation).encode())
+        # results of older generations are never read again
+        for name in os.listdir(self._client_dir(client_id)):
+            if name.startswith(('result-', 'partial-')) and name != f"result-{generation}.pkl":
+                try:
+                    os.remove(self._path(client_id, name))
+                except FileNotFoundError:
+                    pass
+        with self._lock:
+            previous = self._futures.pop(client_id, None)
+            if previous is not None:
+                previous.cancel()
+            for done in [other for other, future in self._futures.items() if future.done()]:
+                del self._futures[done]
+            token = CancelToken(self, client_id, generation)
+            self._futures[client_id] = self._executor.submit(self._run, token, fn, *args)
+        return generation
+
+    def _expire(self) -> None:
+        """ Removes the directories of clients that have not submitted or polled for expire_after seconds
+        """
+        if not os.path.isdir(self.state_dir):
+            return
+        oldest = time.time() - self.expire_after
+        for name in os.listdir(self.state_dir):
+            try:
+                touched = os.path.getmtime(os.path.join(self.state_dir, name, self.generation_file))
+            except OSError:
+                continue
+            if touched < oldest:
+                shutil.rmtree(os.path.join(self.state_dir, name), ignore_errors=True)
+
+    def _run(self, token: CancelToken, fn: Callable, *args: Any) -> None:
+        try:
+            token.check('start')
+            outcome = ('done', fn(token, *args))
+        except JobCancelled:
+            return
+        except Exception as e:
+            outcome = ('error', e)
+        if token.cancelled:
+            return
+        try:
+            payload = pickle.dumps(outcome, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            # pollers in other processes only see what can be pickled
+            payload = pickle.dumps(('error', Exception(f"{outcome[0]} result could not be stored: {e!r}")))
+        if outcome[0] == 'error':
+            print(f"Job {token.client_id}:{token.generation} failed: {outcome[1]!r}")
+        self._atomic_write(self._path(token.client_id, f"result-{token.generation}.pkl"), payload)
+
+    def _publish(self, token: CancelToken, result: Any) -> None:
+        if token.cancelled:
+            return
+        token.published += 1
+        payload = pickle.dumps((token.published, result), protocol=pickle.HIGHEST_PROTOCOL)
+        self._atomic_write(self._path(token.client_id, f"partial-{token.generation}.pkl"), payload)
+
+    def partial(self, client_id: Hashable, generation: int) -> Optional[Tuple[int, Any]]:
+        """ Returns the latest result published by a running job
+
+        :param client_id: client that submitted the job
+        :param generation: generation returned by submit
+        :return: (version, result) where version increases with every publish, None if nothing was published
+        """
+        return self._read_pickle(self._path(client_id, f"partial-{generation}.pkl"))
+
+    def status(self, client_id: Hashable, generation: int) -> Tuple[str, Any]:
+        """ Returns the state of a job and its result once finished
+
+        :param client_id: client that submitted the job
+        :param generation: generation returned by submit
+        :return: ('pending', None), ('done', result), ('error', exception), ('cancelled', None)
+            or ('unknown', None) if the client has no such job, for example after it expired
+        """
+        latest = self.latest_generation(client_id)
+        if latest == 0 or generation > latest:
+            return 'unknown', None
+        if generation != latest:
+            return 'cancelled', None
+        try:
+            os.utime(self._path(client_id, self.generation_file))
+        except FileNotFoundError:
+            return 'unknown', None
+        outcome = self._read_pickle(self._path(client_id, f"result-{generation}.pkl"))
+        if outcome is None:
+            return 'pending', None
+        # intermediate results are not needed once the job finished
+        try:
+            os.remove(self._path(client_id, f"partial-{generation}.pkl"))
+        except FileNotFoundError:
+            pass
+        return outcome
@@ -0,0 +1,162 @@
+import os
+import re
+import json
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class PrefixTrie:
+    """ Digit trie mapping dialing prefixes to a category code. Lookups return the
+        code of the longest prefix that matches the start of the number.
+    """
+
+    def __init__(self) -> None:
+        self._root = {}
+
+    def insert(self, prefix: str, code: int) -> None:
+        """ Adds a prefix to the trie
+
+        :param prefix: string of digits in international format without the leading '+'
+        :param code: category code returned for numbers starting with prefix
+        """
+        if not prefix.isdigit():
+            raise Exception(f"Prefix must only contain digits, received {prefix}")
+        node = self._root
+        for digit in prefix:
+            node = node.setdefault(digit, {})
+        node[None] = code
+
+    def longest_match(self, number: str, default: int) -> int:
+        """ Walks the trie along the digits of number and returns the code of the
+            deepest prefix found
+
+        :param number: string of digits in international format
+        :param default: code returned when no prefix matches
+        :return: category code
+        """
+        node, code = self._root, default
+        for digit in number:
+            node = node.get(digit)
+            if node is None:
+                break
+            code = node.get(None, code)
+        return code
+
+
+class NumberClassifier:
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    categories = ['unclassified', 'toll_free', 'premium', 'mobile', 'restricted']
+    restricted_labels = {'RESTRICTED', 'ANONYMOUS', 'PRIVATE', 'UNAVAILABLE', 'UNKNOWN'}
+    missing_code = -1
+
+    def __init__(self,
+                 prefixes: Dict[str, Any] = None,
+                 default_country_code: str = '1') -> None:
+        """ Classifies calling numbers by matching them against a table of
+            country/area prefixes
+
+        :param prefixes: mapping of category name to list of prefixes, defaults to prefixes/default.json.
+            The optional 'national' entry maps a country code to the trunk_prefix and lengths
+            (trunk prefix included) of its national numbers, and 'countries' maps the country
+            a flow name starts with to its country code.
+        :param default_country_code: country code of numbers dialed in national format
+        """
+        if prefixes is None:
+            prefixes = self.load_prefixes(os.path.join(self.dir_path, 'prefixes', 'default.json'))
+        prefixes = dict(prefixes)
+        self.national_rules: Dict[str, Dict[str, Any]] = prefixes.pop('national', {})
+        self.countries: Dict[str, str] = prefixes.pop('countries', {})
+        self.default_country_code = default_country_code
+        self._trie = PrefixTrie()
+        for category, category_prefixes in prefixes.items():
+            code = self.code(category)
+            for prefix in category_prefixes:
+                self._trie.insert(prefix, code)
+
+    @classmethod
+    def for_flow(cls, flow_name: str, prefixes: Dict[str, Any] = None) -> 'NumberClassifier':
+        """ Returns a classifier treating national numbers as numbers of the flow's country,
+            for example 0800 numbers of 'United Kingdom-Customer Service' as +44 800
+
+        :param flow_name: name of the flow, starting with its country
+        :param prefixes: same as in __init__
+        """
+        classifier = cls(prefixes)
+        classifier.default_country_code = classifier.country_code(flow_name)
+        return classifier
+
+    def country_code(self, flow_name: str) -> str:
+        """ Returns the country code of the longest country name flow_name starts with,
+            default_country_code if there is none
+        """
+        matches = [country for country in self.countries if flow_name.startswith(country)]
+        return self.countries[max(matches, key=len)] if matches else self.default_country_code
+
+    @staticmethod
+    def load_prefixes(file_path: str) -> Dict[str, Any]:
+        """ Reads a json file containing {category: [prefix, ...]} and the optional
+            'national' and 'countries' tables
+
+        :param file_path: path to the json file
+        :return: mapping of category name to list of prefixes
+        """
+        with open(file_path) as f:
+            prefixes = json.load(f)
+        return prefixes
+
+    def code(self, category: str) -> int:
+        """ Returns the integer code stored for a category name
+        """
+        if category not in self.categories:
+            raise Exception(f"category must be one of {self.categories}, received {category}")
+        return self.categories.index(category)
+
+    def _normalize(self, number: str) -> str:
+        """ Strips formatting from a number and returns it in international format
+            without the leading '+'. Restricted labels are returned in upper case.
+        """
+        if number.strip().upper() in self.restricted_labels:
+            return number.strip().upper()
+        digits = re.sub(r'\D', '', number)
+        if number.strip().startswith('+'):
+            return digits
+        if digits.startswith('00'):
+            return digits[2:]
+        # national format: drop the trunk prefix and prepend the country code
+        rule = self.national_rules.get(self.default_country_code)
+        if rule is not None and digits.startswith(rule['trunk_prefix']) and len(digits) in rule['lengths']:
+            return self.default_country_code + digits[len(rule['trunk_prefix']):]
+        return digits
+
+    def classify_number(self, number: Optional[str]) -> int:
+        """ Returns the category code of a single calling number
+
+        :param number: calling number in any common format
+        :return: category code, missing_code for null numbers
+        """
+        if number is None or pd.isna(number):
+            return self.missing_code
+        normalized = self._normalize(str(number))
+        if normalized in self.restricted_labels or normalized == '':
+            return self.code('restricted')
+        return self._trie.longest_match(normalized, self.code('unclassified'))
+
+    def classify(self, numbers: pd.Series) -> pd.Series:
+        """ Classifies a column of calling numbers. Each distinct number is looked
+            up in the trie once and the result is broadcast back to every row.
+
+        :param numbers: series of calling numbers
+        :return: int8 series of category codes aligned with numbers
+        """
+        row_codes, uniques = pd.factorize(numbers)
+        unique_codes = np.array([self.classify_number(number) for number in uniques] + [self.missing_code],
+                                dtype=np.int8)
+        # factorize marks nulls with -1 which selects the trailing missing_code entry
+        return pd.Series(unique_codes[row_codes], index=numbers.index, dtype=np.int8)
+
+    def labels(self, codes: pd.Series) -> pd.Series:
+        """ Converts category codes back to a categorical series of category names
+        """
+        return pd.Series(pd.Categorical.from_codes(codes, self.categories), index=codes.index)
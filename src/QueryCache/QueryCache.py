@@ -0,0 +1,275 @@
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import tempfile
+from typing import Any, Dict, List, Optional, Sequence
+
+
+class QueryCache:
+    """ On-disk cache of query results.
+
+        Entries are stored as <key>.pkl next to a <key>.json metadata file. Keys are
+        versioned and start with the hash of the normalized SQL so that editing a
+        .sql file never serves results of the old query. Writes go to a temporary
+        file that is renamed into place, so concurrent workers only ever see
+        complete entries. The modification time of the .pkl file is used as the
+        last access time for LRU eviction once the total size exceeds max_bytes.
+    """
+    version = 1
+    data_suffix = '.pkl'
+    meta_suffix = '.json'
+
+    def __init__(self,
+                 cachedir: str,
+                 max_bytes: int = 2 * 1024 ** 3,
+                 today_ttl: int = 15 * 60) -> None:
+        """
+        :param cachedir: directory where the entries are stored
+        :param max_bytes: total size of the cache before least recently used entries are evicted
+        :param today_ttl: seconds an entry is valid when its date range includes the current day
+        """
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        self.today_ttl = today_ttl
+
+    @staticmethod
+    def normalize_sql(query: str) -> str:
+        """ Removes comments and collapses whitespace so that formatting changes
+            do not change the hash of a query
+
+        :param query: sql text
+        :return: normalized sql text
+        """
+        query = re.sub(r'--[^\n]*', '', query)
+        query = re.sub(r'/\*.*?\*/', '', query, flags=re.DOTALL)
+        return ' '.join(query.split())
+
+    def sql_hash(self, query: str) -> str:
+        """ Returns a short hash of the normalized sql text
+        """
+        return hashlib.sha256(self.normalize_sql(query).encode()).hexdigest()[:16]
+
+    def key(self, query: str, params: Sequence[str]) -> str:
+        """ Returns the cache key for a query and the parameters formatted into it
+
+        :param query: sql text before formatting
+        :param params: values formatted into the query
+        :return: key in the form v<version>-<sql hash>-<params hash>
+        """
+        params_hash = hashlib.sha256(json.dumps([str(p) for p in params]).encode()).hexdigest()[:16]
+        return f"v{self.version}-{self.sql_hash(query)}-{params_hash}"
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cachedir, key + suffix)
+
+    def _atomic_write(self, path: str, payload: bytes) -> None:
+        """ Writes payload to a temporary file in the cache directory and renames
+            it to path, which is atomic on POSIX and Windows
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cachedir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _read_meta(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(key, self.meta_suffix)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, query: str, params: Sequence[str]) -> Optional[Any]:
+        """ Returns the cached result of a query or None if it is missing or expired
+
+        :param query: sql text before formatting
+        :param params: values formatted into the query
+        :return: cached value or None
+        """
+        key = self.key(query, params)
+        meta = self._read_meta(key)
+        if meta is None:
+            return None
+        if meta['expires'] is not None and meta['expires'] < time.time():
+            print(f"Cache entry {key} expired")
+            self._remove_if_unchanged(key, meta)
+            return None
+        data_path = self._path(key, self.data_suffix)
+        try:
+            with open(data_path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError):
+            return None
+        except (pickle.UnpicklingError, AttributeError, ImportError) as e:
+            # written by an incompatible version of a library, e.g. after a pandas upgrade
+            print(f"Cache entry {key} could not be loaded: {e!r}")
+            self._remove_if_unchanged(key, meta)
+            return None
+        try:
+            os.utime(data_path)
+        except FileNotFoundError:
+            # evicted by another process after it was read, the value is still valid
+            pass
+        return value
+
+    def set(self,
+            query: str,
+            params: Sequence[str],
+            value: Any,
+            ttl: Optional[int] = None) -> None:
+        """ Stores the result of a query and evicts old entries if the cache is over max_bytes
+
+        :param query: sql text before formatting
+        :param params: values formatted into the query
+        :param value: result to be cached
+        :param ttl: seconds before the entry expires, None never expires
+        """
+        os.makedirs(self.cachedir, exist_ok=True)
+        key = self.key(query, params)
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        meta = {'key': key,
+                'version': self.version,
+                'sql_hash': self.sql_hash(query),
+                'params': [str(p) for p in params],
+                'created': now,
+                'expires': now + ttl if ttl is not None else None,
+                'size': len(payload)}
+        # data is written before metadata so a visible metadata file always has its data
+        self._atomic_write(self._path(key, self.data_suffix), payload)
+        self._atomic_write(self._path(key, self.meta_suffix), json.dumps(meta).encode())
+        self.evict()
+
+    def _remove_if_unchanged(self, key: str, meta: Dict[str, Any]) -> None:
+        """ Removes an entry only if it is still the one described by meta, so that an entry
+            written by another worker since meta was read is not deleted
+        """
+        current = self._read_meta(key)
+        if current is not None and current.get('created') == meta.get('created'):
+            self.remove(key)
+
+    def remove(self, key: str) -> None:
+        """ Deletes an entry, ignoring files already removed by another worker
+        """
+        for suffix in (self.meta_suffix, self.data_suffix):
+            try:
+                os.remove(self._path(key, suffix))
+            except FileNotFoundError:
+                pass
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """ Returns the metadata of every entry with its last access time
+
+        :return: list of metadata dicts sorted from least to most recently used
+        """
+        if not os.path.isdir(self.cachedir):
+            return []
+        entries = []
+        for filename in os.listdir(self.cachedir):
+            if not filename.endswith(self.meta_suffix) or filename.startswith('.'):
+                continue
+            meta = self._read_meta(filename[:-len(self.meta_suffix)])
+            if meta is None:
+                continue
+            try:
+                meta['last_access'] = os.path.getmtime(self._path(meta['key'], self.data_suffix))
+            except OSError:
+                continue
+            entries.append(meta)
+        return sorted(entries, key=lambda entry: entry['last_access'])
+
+    def evict(self) -> None:
+        """ Removes least recently used entries until the cache is under max_bytes
+        """
+        entries = self.entries()
+        total = sum(entry['size'] for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            print(f"Evicting cache entry {entry['key']}")
+            self.remove(entry['key'])
+            total -= entry['size']
+
+    def purge(self,
+              expired: bool = False,
+              sql_hash: str = None,
+              older_than: float = None) -> int:
+        """ Deletes entries matching all the given filters, every entry if none are given
+
+        :param expired: only remove entries past their ttl
+        :param sql_hash: only remove entries created by this sql hash
+        :param older_than: only remove entries last used more than this many seconds ago
+        :return: number of entries removed
+        """
+        now = time.time()
+        removed = 0
+        for entry in self.entries():
+            if expired and (entry['expires'] is None or entry['expires'] >= now):
+                continue
+            if sql_hash is not None and entry['sql_hash'] != sql_hash:
+                continue
+            if older_than is not None and now - entry['last_access'] < older_than:
+                continue
+            self.remove(entry['key'])
+            removed += 1
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        """ Returns the number of entries, total size and entries per sql hash
+        """
+        entries = self.entries()
+        by_sql = {}
+        for entry in entries:
+            by_sql[entry['sql_hash']] = by_sql.get(entry['sql_hash'], 0) + 1
+        now = time.time()
+        return {'cachedir': self.cachedir,
+                'entries': len(entries),
+                'bytes': sum(entry['size'] for entry in entries),
+                'max_bytes': self.max_bytes,
+                'expired': sum(1 for e in entries if e['expires'] is not None and e['expires'] < now),
+                'entries_per_sql_hash': by_sql}
+
+
+def main(argv: List[str] = None) -> None:
+    """ Command line interface to list, stat and purge a cache directory
+
+    Example: python src/QueryCache/QueryCache.py src/Flow/data/query_cache purge --expired
+    """
+    parser = argparse.ArgumentParser(description='Inspect and purge the on-disk query cache')
+    parser.add_argument('cachedir', help='cache directory')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='list entries from least to most recently used')
+    subparsers.add_parser('stat', help='print totals for the cache')
+    purge_parser = subparsers.add_parser('purge', help='delete entries, all of them if no filter is given')
+    purge_parser.add_argument('--expired', action='store_true', help='only entries past their ttl')
+    purge_parser.add_argument('--sql-hash', help='only entries created by this sql hash')
+    purge_parser.add_argument('--older-than', type=float, help='only entries unused for this many hours')
+    args = parser.parse_args(argv)
+
+    cache = QueryCache(args.cachedir)
+    if args.command == 'list':
+        for entry in cache.entries():
+            expires = ('never' if entry['expires'] is None
+                       else time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['expires'])))
+            print(f"{entry['key']}  {entry['size']:>12}  "
+                  f"last used {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_access']))}  "
+                  f"expires {expires}  params {entry['params']}")
+    elif args.command == 'stat':
+        print(json.dumps(cache.stats(), indent=2))
+    else:
+        older_than = args.older_than * 3600 if args.older_than is not None else None
+        removed = cache.purge(expired=args.expired, sql_hash=args.sql_hash, older_than=older_than)
+        print(f"Removed {removed} entries")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,69 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable
+
+
+class QueryScheduler:
+    """ Runs blocking warehouse queries on a bounded thread pool.
+
+        Requests are identified by a key. While a request is running, any other
+        request with the same key receives the same future instead of starting
+        a second job (single-flight). The key is released as soon as the job
+        finishes, so later requests run again (and usually hit the query cache).
+    """
+    _shared = None
+    _shared_pid = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_workers: int = 4) -> None:
+        """
+        :param max_workers: maximum number of queries running at the same time
+        """
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query')
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> 'QueryScheduler':
+        """ Returns the scheduler shared by every module in this process. A forked child
+            inherits the parent's scheduler without its threads, so it gets a new one.
+        """
+        with cls._shared_lock:
+            if cls._shared is None or cls._shared_pid != os.getpid():
+                cls._shared = cls()
+                cls._shared_pid = os.getpid()
+            return cls._shared
+
+    def submit(self, key: Hashable, fn: Callable, *args: Any) -> Future:
+        """ Schedules fn(*args) unless a request with the same key is already running
+
+        :param key: identifies identical requests, usually the query cache key
+        :param fn: blocking function that runs the query
+        :param args: arguments passed to fn
+        :return: future holding the result of fn
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                print(f"Joining in-flight query {key}")
+                return future
+            future = self._executor.submit(fn, *args)
+            self._in_flight[key] = future
+        future.add_done_callback(lambda done: self._release(key, done))
+        return future
+
+    def _release(self, key: Hashable, future: Future) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def in_flight(self) -> int:
+        """ Returns the number of distinct requests currently running or queued
+        """
+        with self._lock:
+            return len(self._in_flight)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
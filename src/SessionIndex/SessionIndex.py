@@ -0,0 +1,257 @@
+import datetime
+from typing import Callable, Dict, Hashable, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src import SessionSequence
+
+
+class SessionBitmap:
+    """ Compressed set of uint32 session ids in the style of a roaring bitmap.
+
+        Ids are split into chunks by their upper 16 bits. A chunk holding at most
+        array_max ids is stored as a sorted uint16 array, a denser chunk as a
+        65536 bit bitset (1024 uint64 words). Set operations work chunk by chunk
+        with numpy on whichever representation each side uses.
+    """
+    array_max = 4096
+    words = 1024
+
+    def __init__(self, containers: Dict[int, np.ndarray] = None) -> None:
+        self._containers = containers if containers is not None else {}
+
+    @classmethod
+    def from_sorted(cls, ids: np.ndarray) -> 'SessionBitmap':
+        """ Builds a bitmap from sorted unique ids
+
+        :param ids: sorted array of unique non negative ids below 2**32
+        :return: bitmap containing ids
+        """
+        ids = np.asarray(ids, dtype=np.uint32)
+        containers = {}
+        if len(ids) == 0:
+            return cls(containers)
+        highs = ids >> 16
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(highs)) + 1))
+        ends = np.concatenate((starts[1:], [len(ids)]))
+        for start, end in zip(starts, ends):
+            lows = (ids[start:end] & 0xFFFF).astype(np.uint16)
+            containers[int(highs[start])] = lows if len(lows) <= cls.array_max else cls._to_bitset(lows)
+        return cls(containers)
+
+    @classmethod
+    def from_range(cls, start: int, stop: int) -> 'SessionBitmap':
+        """ Builds a bitmap holding every id from start up to but excluding stop
+        """
+        return cls.from_sorted(np.arange(start, max(start, stop), dtype=np.uint32))
+
+    @staticmethod
+    def _is_bitset(container: np.ndarray) -> bool:
+        return container.dtype == np.uint64
+
+    @classmethod
+    def _to_bitset(cls, lows: np.ndarray) -> np.ndarray:
+        bits = np.zeros(cls.words * 64, dtype=bool)
+        bits[lows] = True
+        return np.packbits(bits, bitorder='little').view(np.uint64)
+
+    @staticmethod
+    def _to_array(bitset: np.ndarray) -> np.ndarray:
+        return np.flatnonzero(np.unpackbits(bitset.view(np.uint8), bitorder='little')).astype(np.uint16)
+
+    @staticmethod
+    def _cardinality(container: np.ndarray) -> int:
+        if container.dtype == np.uint64:
+            return int(np.unpackbits(container.view(np.uint8)).sum())
+        return len(container)
+
+    @staticmethod
+    def _contains(bitset: np.ndarray, lows: np.ndarray) -> np.ndarray:
+        lows = lows.astype(np.uint64)
+        return ((bitset[lows >> np.uint64(6)] >> (lows & np.uint64(63))) & np.uint64(1)).astype(bool)
+
+    @classmethod
+    def _compact(cls, container: np.ndarray) -> np.ndarray:
+        """ Returns the cheaper representation for the number of ids in container
+        """
+        if cls._is_bitset(container):
+            if cls._cardinality(container) <= cls.array_max:
+                return cls._to_array(container)
+            return container
+        if len(container) > cls.array_max:
+            return cls._to_bitset(container)
+        return container
+
+    @classmethod
+    def _and(cls, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        if cls._is_bitset(a) and cls._is_bitset(b):
+            return cls._compact(a & b)
+        if cls._is_bitset(a):
+            return b[cls._contains(a, b)]
+        if cls._is_bitset(b):
+            return a[cls._contains(b, a)]
+        return np.intersect1d(a, b, assume_unique=True)
+
+    @classmethod
+    def _or(cls, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        if not cls._is_bitset(a) and not cls._is_bitset(b):
+            return cls._compact(np.union1d(a, b).astype(np.uint16))
+        a = a if cls._is_bitset(a) else cls._to_bitset(a)
+        b = b if cls._is_bitset(b) else cls._to_bitset(b)
+        return a | b
+
+    @classmethod
+    def _andnot(cls, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        if cls._is_bitset(a):
+            b = b if cls._is_bitset(b) else cls._to_bitset(b)
+            return cls._compact(a & ~b)
+        if cls._is_bitset(b):
+            return a[~cls._contains(b, a)]
+        return np.setdiff1d(a, b, assume_unique=True)
+
+    def _result(self, containers: Dict[int, np.ndarray]) -> 'SessionBitmap':
+        return SessionBitmap({key: c for key, c in containers.items() if self._cardinality(c) > 0})
+
+    def __and__(self, other: 'SessionBitmap') -> 'SessionBitmap':
+        keys = self._containers.keys() & other._containers.keys()
+        return self._result({key: self._and(self._containers[key], other._containers[key]) for key in keys})
+
+    def __or__(self, other: 'SessionBitmap') -> 'SessionBitmap':
+        containers = dict(self._containers)
+        for key, container in other._containers.items():
+            containers[key] = self._or(containers[key], container) if key in containers else container
+        return SessionBitmap(containers)
+
+    def __sub__(self, other: 'SessionBitmap') -> 'SessionBitmap':
+        return self._result({key: (self._andnot(c, other._containers[key]) if key in other._containers else c)
+                             for key, c in self._containers.items()})
+
+    def __len__(self) -> int:
+        return sum(self._cardinality(c) for c in self._containers.values())
+
+    @property
+    def nbytes(self) -> int:
+        return sum(c.nbytes for c in self._containers.values())
+
+    def to_array(self) -> np.ndarray:
+        """ Returns the ids as a sorted uint32 array
+        """
+        parts = []
+        for key in sorted(self._containers):
+            container = self._containers[key]
+            lows = self._to_array(container) if self._is_bitset(container) else container
+            parts.append((np.uint32(key) << np.uint32(16)) | lows.astype(np.uint32))
+        return np.concatenate(parts) if parts else np.array([], dtype=np.uint32)
+
+
+class SessionIndex:
+    """ Inverted index from path, event, edge and session attributes to the
+        sessions of a SessionSequence.
+
+        Session ids are the ids of the sequence, which orders sessions by their
+        first event, so the sessions that started inside a date range are a
+        contiguous range of ids. Posting lists are built from the integer codes of
+        the sequence, without decoding its events, and each is a SessionBitmap
+        that lookups combine with & | and -.
+
+        Example: index.path('3-Path_Freq_Rank') & index.callbacks()
+    """
+    metric_columns = ['user_id', 'date', 'path_nickname', 'events', 'session_duration', 'callback_instance',
+                      'TollFreeNumber']
+
+    def __init__(self, sequence: SessionSequence) -> None:
+        """
+        :param sequence: events of the flow, such as Flow.session_sequence()
+        """
+        self.sequence = sequence
+        self._first_event = sequence.start_times()
+        sessions = np.arange(len(sequence), dtype=np.int64)
+        event_names = sequence.vocabularies['event_name']
+
+        self._postings: Dict[Tuple[str, Hashable], SessionBitmap] = {}
+        self._add('path', sessions, sequence.columns['path_nickname'], sequence.vocabularies['path_nickname'].take)
+        self._add('event', sequence.session_ids(), sequence.event_codes, event_names.take)
+        has_next = np.ones(sequence.n_events, dtype=bool)
+        has_next[sequence.offsets[1:] - 1] = False
+        positions = np.flatnonzero(has_next)
+        n_events = len(event_names)
+        self._add('edge',
+                  sequence.session_ids()[positions],
+                  sequence.event_codes[positions].astype(np.int64) * n_events + sequence.event_codes[positions + 1],
+                  lambda codes: [tuple(edge) for edge in event_names.take(np.stack(np.divmod(codes, n_events), 1))])
+        self._add('tollfree', sessions, sequence.columns['TollFreeNumber'],
+                  sequence.vocabularies['TollFreeNumber'].take)
+        # callback_instance is the rank of the call among calls from the same number
+        with np.errstate(invalid='ignore'):
+            callbacks = np.asarray(sequence.columns['callback_instance'], dtype=np.float64) > 1
+        self._add('callback', sessions, np.where(callbacks, 0, -1), lambda codes: np.full(len(codes), True))
+        print(f"SessionIndex built for {len(sequence)} sessions and {len(self._postings)} keys "
+              f"using {sum(p.nbytes for p in self._postings.values())} bytes")
+
+    def _add(self, kind: str, sessions: np.ndarray, codes: np.ndarray, decode: Callable) -> None:
+        """ Adds one posting list per distinct code, negative codes being missing values
+
+        :param kind: first element of the posting keys
+        :param sessions: session of every code
+        :param codes: integer key of every row
+        :param decode: returns the keys of an array of distinct codes
+        """
+        keep = codes >= 0
+        n_sessions = max(len(self.sequence), 1)
+        pairs = np.unique(codes[keep].astype(np.int64) * n_sessions + sessions[keep])
+        codes, sessions = np.divmod(pairs, n_sessions)
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.array([], dtype=int)
+        stops = np.r_[starts[1:], len(codes)]
+        for key, start, stop in zip(decode(codes[starts]), starts, stops):
+            self._postings[(kind, key)] = SessionBitmap.from_sorted(sessions[start:stop])
+
+    def get(self, kind: str, key: Hashable) -> SessionBitmap:
+        """ Returns the sessions posted under (kind, key), an empty bitmap if there are none
+        """
+        return self._postings.get((kind, key), SessionBitmap())
+
+    def path(self, path_nickname: str) -> SessionBitmap:
+        return self.get('path', path_nickname)
+
+    def event(self, event_name: str) -> SessionBitmap:
+        return self.get('event', event_name)
+
+    def edge(self, source: str, target: str) -> SessionBitmap:
+        return self.get('edge', (source, target))
+
+    def tollfree(self, label: str) -> SessionBitmap:
+        return self.get('tollfree', label)
+
+    def callbacks(self) -> SessionBitmap:
+        return self.get('callback', True)
+
+    def all(self) -> SessionBitmap:
+        return SessionBitmap.from_range(0, len(self.sequence))
+
+    def date_range(self,
+                   start_date: datetime.date = None,
+                   end_date: datetime.date = None) -> SessionBitmap:
+        """ Returns the sessions whose first event is on or after start_date and before end_date
+        """
+        times = self._first_event
+        start = 0 if start_date is None else times.searchsorted(self._as_timestamp(start_date, times))
+        stop = len(times) if end_date is None else times.searchsorted(self._as_timestamp(end_date, times))
+        return SessionBitmap.from_range(start, stop)
+
+    @staticmethod
+    def _as_timestamp(date: datetime.date, times: pd.DatetimeIndex) -> pd.Timestamp:
+        timestamp = pd.Timestamp(date)
+        return timestamp.tz_localize(times.tz) if times.tz is not None else timestamp
+
+    def metrics(self, sessions: SessionBitmap) -> pd.DataFrame:
+        """ Returns one row of metrics per session in the bitmap
+
+        :param sessions: bitmap returned by the lookups of this index
+        :return: dataframe with user_id, date, path_nickname, events, session_duration,
+            callback_instance and TollFreeNumber
+        """
+        mask = np.zeros(len(self.sequence), dtype=bool)
+        mask[sessions.to_array()] = True
+        metrics = self.sequence.session_metrics(mask)
+        return metrics[[column for column in self.metric_columns if column in metrics.columns]]
@@ -0,0 +1,473 @@
+import os
+import json
+import datetime
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class StringArray:
+    """ Read-only array of strings laid out like an Arrow string array: the UTF-8
+        bytes of every value back to back in data, value i being
+        data[offsets[i]:offsets[i + 1]]. Both arrays can be memory-mapped, values
+        are only decoded to Python strings when they are indexed.
+    """
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray) -> None:
+        """
+        :param offsets: int64 array of length values + 1
+        :param data: uint8 array of UTF-8 bytes
+        """
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_values(cls, values: Iterable) -> 'StringArray':
+        """ Builds the array from values, which are stored as str
+        """
+        encoded = [str(value).encode('utf-8') for value in values]
+        offsets = np.r_[0, np.cumsum([len(value) for value in encoded], dtype=np.int64)].astype(np.int64)
+        return cls(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.data.nbytes
+
+    def _value(self, i: int) -> str:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self._value(int(index))
+        return self.take(index)
+
+    def take(self, codes: np.ndarray) -> np.ndarray:
+        """ Returns the values of codes as an object array, code -1 giving None. Each
+            distinct code is decoded once.
+        """
+        codes = np.asarray(codes)
+        unique, inverse = np.unique(codes, return_inverse=True)
+        values = np.empty(len(unique), dtype=object)
+        values[:] = [None if code < 0 else self._value(code) for code in unique]
+        return values[inverse].reshape(codes.shape)
+
+    def find(self, value: str) -> int:
+        """ Returns the position of value, -1 if it is not in the array
+        """
+        encoded = value.encode('utf-8')
+        for i in np.flatnonzero(np.diff(self.offsets) == len(encoded)):
+            if bytes(self.data[self.offsets[i]:self.offsets[i + 1]]) == encoded:
+                return int(i)
+        return -1
+
+    def tolist(self) -> List[str]:
+        return [self._value(i) for i in range(len(self))]
+
+    def save(self, directory: str, name: str) -> None:
+        np.save(os.path.join(directory, f"{name}.offsets.npy"), self.offsets)
+        np.save(os.path.join(directory, f"{name}.data.npy"), self.data)
+
+    @classmethod
+    def load(cls, directory: str, name: str, mmap_mode: str = None) -> 'StringArray':
+        return cls(np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, f"{name}.data.npy"), mmap_mode=mmap_mode))
+
+
+class SessionSequence:
+    """ Compressed sparse row layout of the events of a Flow.master dataset.
+
+        The events of session i are the rows offsets[i]:offsets[i + 1] of the event
+        arrays: event_codes (int32 index into the event_name vocabulary) and
+        time_offsets (int32 milliseconds since the session's first event).
+        Everything that is constant within a session, such as path_nickname or
+        CallingNumber, is stored once per session. Text columns are int32 codes
+        into a StringArray vocabulary, -1 meaning missing. Sessions are ordered by
+        their first event so a date range is a contiguous range of sessions.
+
+        save writes every array, vocabularies included, as a .npy file, so a
+        sequence loaded with mmap_mode='r' holds no per-process copy of the data.
+
+        Example: SessionSequence.from_events(flow.master).transitions(by=['path_nickname'])
+    """
+    categorical_columns = ['user_id', 'FlowName', 'path_nickname', 'CallingNumber', 'TollFreeNumber']
+    numeric_columns = ['callback_instance', 'days_since_last_call', 'session_duration', 'previous_duration',
+                       'number_category']
+    meta_file = 'meta.json'
+
+    def __init__(self,
+                 offsets: np.ndarray,
+                 event_codes: np.ndarray,
+                 time_offsets: np.ndarray,
+                 session_start: np.ndarray,
+                 columns: Dict[str, np.ndarray],
+                 vocabularies: Dict[str, StringArray],
+                 tz: str = None,
+                 dtypes: Dict[str, str] = None) -> None:
+        """
+        :param offsets: int64 array of length sessions + 1, start of every session in the event arrays
+        :param event_codes: int32 code of every event in the event_name vocabulary
+        :param time_offsets: int32 milliseconds between every event and the first event of its session
+        :param session_start: int64 nanoseconds since epoch (UTC) of the first event of every session
+        :param columns: per session columns, codes for the columns that have a vocabulary
+        :param vocabularies: values of event_name and of every coded column
+        :param tz: timezone of time_event, None if the timestamps are naive
+        :param dtypes: pandas dtype of the per session columns read from a nullable column, such as Int64
+        """
+        self.offsets = offsets
+        self.event_codes = event_codes
+        self.time_offsets = time_offsets
+        self.session_start = session_start
+        self.columns = columns
+        self.vocabularies = vocabularies
+        self.tz = tz
+        self.dtypes = dtypes if dtypes is not None else {}
+
+    @classmethod
+    def from_events(cls, events: pd.DataFrame) -> 'SessionSequence':
+        """ Builds the sequence from an event level dataset such as Flow.master
+
+        :param events: dataset returned by user_sequence.sql, with TollFreeNumber and
+            number_category if the calling numbers were classified
+        :return: sequence holding the same events
+        """
+        order = ['user_id', 'rank_event'] if 'rank_event' in events.columns else ['user_id', 'time_event']
+        events = events.sort_values(order, kind='mergesort')
+        session, _ = pd.factorize(events['user_id'])
+        times = pd.DatetimeIndex(events['time_event'])
+        utc = times.tz_convert(None) if times.tz is not None else times
+        nanoseconds = utc.to_numpy().astype('datetime64[ns]').astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, session[1:] != session[:-1]]) if len(events) else np.array([], int)
+        lengths = np.diff(np.r_[starts, len(events)])
+
+        # sessions are laid out in order of their first event
+        session_order = np.argsort(nanoseconds[starts], kind='mergesort')
+        starts, lengths = starts[session_order], lengths[session_order]
+        offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        event_index = np.repeat(starts - offsets[:-1], lengths) + np.arange(len(events))
+
+        session_start = nanoseconds[starts]
+        time_offsets = (nanoseconds[event_index] - np.repeat(session_start, lengths)) // 1000000
+        if len(time_offsets) and time_offsets.max() > np.iinfo(np.int32).max:
+            raise Exception("Sessions longer than 24 days cannot be stored as int32 milliseconds")
+        event_codes, event_names = pd.factorize(events['event_name'].to_numpy()[event_index])
+
+        columns, vocabularies, dtypes = {}, {'event_name': StringArray.from_values(event_names)}, {}
+        for column in cls.categorical_columns:
+            if column in events.columns:
+                codes, uniques = pd.factorize(events[column].to_numpy()[starts])
+                columns[column] = codes.astype(np.int32)
+                vocabularies[column] = StringArray.from_values(uniques)
+        for column in cls.numeric_columns:
+            if column in events.columns:
+                columns[column] = cls._numeric(events[column])[starts]
+                if not isinstance(events[column].dtype, np.dtype):
+                    dtypes[column] = str(events[column].dtype)
+        return cls(offsets, event_codes.astype(np.int32), time_offsets.astype(np.int32),
+                   session_start.astype(np.int64), columns, vocabularies, None if times.tz is None else str(times.tz),
+                   dtypes)
+
+    @staticmethod
+    def _numeric(series: pd.Series) -> np.ndarray:
+        """ Returns the values of a numeric column, nullable integers become float64 with NaN
+            and get their dtype back in to_events and session_metrics
+        """
+        if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+            return series.to_numpy()
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def n_events(self) -> int:
+        return len(self.event_codes)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """ Number of events of every session
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.offsets, self.event_codes, self.time_offsets, self.session_start] + list(self.columns.values())
+        return sum(array.nbytes for array in arrays) + sum(values.nbytes for values in self.vocabularies.values())
+
+    def session_ids(self) -> np.ndarray:
+        """ Session of every event
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def _decode(self, vocabulary: str, codes: np.ndarray) -> np.ndarray:
+        return self.vocabularies[vocabulary].take(codes)
+
+    def column(self, name: str, sessions: np.ndarray = None) -> np.ndarray:
+        """ Returns a per session column with codes replaced by their values
+
+        :param name: column name, such as path_nickname
+        :param sessions: session ids to return, all sessions if None
+        """
+        values = self.columns[name] if sessions is None else self.columns[name][sessions]
+        return self._decode(name, values) if name in self.vocabularies else values
+
+    def _frame_column(self, name: str, sessions: np.ndarray) -> np.ndarray:
+        """ Same as column, with nullable columns restored to the dtype they had in the events
+        """
+        values = self.column(name, sessions)
+        return pd.array(values, dtype=self.dtypes[name]) if name in self.dtypes else values
+
+    def start_times(self) -> pd.DatetimeIndex:
+        """ Timestamp of the first event of every session
+        """
+        return self._timestamps(self.session_start)
+
+    def _timestamps(self, nanoseconds: np.ndarray) -> pd.DatetimeIndex:
+        times = pd.DatetimeIndex(np.asarray(nanoseconds, dtype='datetime64[ns]'))
+        return times.tz_localize('UTC').tz_convert(self.tz) if self.tz is not None else times
+
+    def session_mask(self,
+                     start_date: datetime.date = None,
+                     end_date: datetime.date = None,
+                     tollfree: str = None) -> np.ndarray:
+        """ Selects the sessions that start on or after start_date, before end_date and
+            optionally have a given TollFreeNumber label
+
+        :return: boolean array with one entry per session
+        """
+        times = self.start_times()
+        bounds = []
+        for date in (start_date, end_date):
+            timestamp = pd.Timestamp(date) if date is not None else None
+            if timestamp is not None and times.tz is not None:
+                timestamp = timestamp.tz_localize(times.tz)
+            bounds.append(timestamp)
+        start = 0 if bounds[0] is None else times.searchsorted(bounds[0])
+        stop = len(self) if bounds[1] is None else times.searchsorted(bounds[1])
+        mask = np.zeros(len(self), dtype=bool)
+        mask[start:stop] = True
+        if tollfree is not None:
+            mask &= self.column('TollFreeNumber') == tollfree
+        return mask
+
+    def _selected(self, session_mask: np.ndarray = None) -> np.ndarray:
+        return np.arange(len(self)) if session_mask is None else np.flatnonzero(session_mask)
+
+    def session_dates(self) -> np.ndarray:
+        """ Day of the first event of every session, in the timezone of time_event
+
+        :return: datetime64[ns] array of midnights
+        """
+        times = self.start_times()
+        return (times.tz_localize(None) if times.tz is not None else times).floor('D').to_numpy()
+
+    def _group_keys(self, by: Sequence[str]) -> Tuple[np.ndarray, List[Tuple[str, int, np.ndarray]]]:
+        """ Combines per session grouping columns into one int64 key per session
+
+        :param by: 'date' or names of coded per session columns such as path_nickname
+        :return: key of every session and the name, number of codes and dates (None for coded
+            columns) of every grouping column
+        """
+        keys = np.zeros(len(self), dtype=np.int64)
+        groups = []
+        for name in by:
+            if name == 'date':
+                dates, codes = np.unique(self.session_dates(), return_inverse=True)
+                cardinality = len(dates)
+            else:
+                # code 0 is a missing value
+                dates, codes = None, self.columns[name].astype(np.int64) + 1
+                cardinality = len(self.vocabularies[name]) + 1
+            keys = keys * cardinality + codes
+            groups.append((name, cardinality, dates))
+        return keys, groups
+
+    def _group_frame(self, keys: np.ndarray, groups: List[Tuple[str, int, np.ndarray]]) -> pd.DataFrame:
+        """ Splits keys built by _group_keys back into one decoded column per grouping column
+        """
+        columns = {}
+        for name, cardinality, dates in reversed(groups):
+            keys, codes = np.divmod(keys, cardinality)
+            columns[name] = dates[codes] if dates is not None else self._decode(name, codes - 1)
+        df = pd.DataFrame()
+        for name, _, _ in groups:
+            df[name] = columns[name]
+        return df
+
+    def transitions(self, session_mask: np.ndarray = None, by: Sequence[str] = ()) -> pd.DataFrame:
+        """ Counts every event to next_event transition inside the sessions
+
+        :param session_mask: sessions included, all sessions if None
+        :param by: per session columns the transitions are also split by, 'date' being the
+            day the session started
+        :return: dataframe with the by columns, event_name, next_event, count, time_sum and the
+            mean time_from_start of the source event
+        """
+        has_next = np.ones(self.n_events, dtype=bool)
+        has_next[self.offsets[1:] - 1] = False
+        if session_mask is not None:
+            has_next &= np.repeat(session_mask, self.lengths)
+        positions = np.flatnonzero(has_next)
+        session_keys, groups = self._group_keys(by)
+        n_events = len(self.vocabularies['event_name'])
+        keys = (np.repeat(session_keys, self.lengths)[positions] * n_events ** 2
+                + self.event_codes[positions].astype(np.int64) * n_events + self.event_codes[positions + 1])
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(keys))
+        time_sum = np.bincount(inverse, weights=self.time_offsets[positions] // 1000, minlength=len(keys))
+        time_sum = time_sum.astype(np.int64)
+
+        keys, event_keys = np.divmod(keys, n_events ** 2)
+        source, target = np.divmod(event_keys, n_events)
+        df = self._group_frame(keys, groups)
+        df['event_name'] = self._decode('event_name', source)
+        df['next_event'] = self._decode('event_name', target)
+        df['count'] = counts
+        df['time_sum'] = time_sum
+        df['time_from_start'] = time_sum / np.maximum(counts, 1)
+        return df
+
+    def node_ranks(self,
+                   session_mask: np.ndarray = None,
+                   by: Sequence[str] = (),
+                   next_event: bool = False) -> pd.DataFrame:
+        """ Counts the events of every event_name at every rank_event, the Sankey node positions
+
+        :param session_mask: sessions included, all sessions if None
+        :param by: per session columns the counts are also split by, see transitions
+        :param next_event: count the next_event of every event that has one instead of the event
+        :return: dataframe with the by columns, node, rank_event and count
+        """
+        selected = np.ones(self.n_events, dtype=bool)
+        if next_event:
+            selected[self.offsets[1:] - 1] = False
+        if session_mask is not None:
+            selected &= np.repeat(session_mask, self.lengths)
+        positions = np.flatnonzero(selected)
+        ranks = positions - np.repeat(self.offsets[:-1], self.lengths)[positions] + 1
+        session_keys, groups = self._group_keys(by)
+        n_events = len(self.vocabularies['event_name'])
+        n_ranks = int(self.lengths.max(initial=0)) + 1
+        codes = self.event_codes[positions + 1 if next_event else positions].astype(np.int64)
+        keys = (np.repeat(session_keys, self.lengths)[positions] * n_events + codes) * n_ranks + ranks
+        keys, counts = np.unique(keys, return_counts=True)
+
+        keys, ranks = np.divmod(keys, n_ranks)
+        keys, codes = np.divmod(keys, n_events)
+        df = self._group_frame(keys, groups)
+        df['node'] = self._decode('event_name', codes)
+        df['rank_event'] = ranks
+        df['count'] = counts
+        return df
+
+    def session_metrics(self, session_mask: np.ndarray = None) -> pd.DataFrame:
+        """ Returns one row per session with its attributes, number of events and the
+            seconds between its first and last event
+
+        :param session_mask: sessions included, all sessions if None
+        :return: dataframe with one row per session
+        """
+        sessions = self._selected(session_mask)
+        df = pd.DataFrame({'date': self.session_dates()[sessions],
+                           'events': self.lengths[sessions],
+                           'duration': self.time_offsets[self.offsets[sessions + 1] - 1] // 1000})
+        for name in self.columns:
+            df[name] = self._frame_column(name, sessions)
+        return df
+
+    def to_events(self, session_mask: np.ndarray = None) -> pd.DataFrame:
+        """ Converts back to the event level dataframe returned by user_sequence.sql, which
+            is what the plot methods expect. Events are ordered by session then rank_event.
+
+        :param session_mask: sessions included, all sessions if None
+        :return: event level dataframe
+        """
+        sessions = self._selected(session_mask)
+        lengths = self.lengths[sessions]
+        first = np.repeat(self.offsets[sessions], lengths)
+        total = int(lengths.sum())
+        position = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        index = first + position
+        is_last = position == np.repeat(lengths, lengths) - 1
+        next_index = np.minimum(index + 1, max(self.n_events - 1, 0))
+
+        time_offsets = self.time_offsets[index].astype(np.int64)
+        next_offsets = np.where(is_last, 0, self.time_offsets[next_index])
+        session_start = np.repeat(self.session_start[sessions], lengths)
+        time_event = self._timestamps(session_start + time_offsets * 1000000)
+        session_of_event = np.repeat(sessions, lengths)
+
+        df = pd.DataFrame({'user_id': self.column('user_id', session_of_event),
+                           'event_name': self._decode('event_name', self.event_codes[index]),
+                           'time_event': time_event,
+                           'date': (time_event.tz_localize(None) if time_event.tz is not None
+                                    else time_event).floor('D'),
+                           'rank_event': position + 1,
+                           'next_event': self._decode('event_name', np.where(is_last, -1,
+                                                                             self.event_codes[next_index])),
+                           'FlowName': self.column('FlowName', session_of_event),
+                           'time_from_start': time_offsets // 1000,
+                           'time_to_next': np.where(is_last, np.nan, (next_offsets - time_offsets) // 1000),
+                           'path_nickname': self.column('path_nickname', session_of_event),
+                           'count': np.ones(total, dtype=np.int64)})
+        for name in ['CallingNumber'] + self.numeric_columns + ['TollFreeNumber']:
+            if name in self.columns:
+                df[name] = self._frame_column(name, session_of_event)
+        return df
+
+    def save(self, directory: str) -> None:
+        """ Writes every array and vocabulary as .npy files and their names to meta.json
+
+        :param directory: directory created if it does not exist
+        """
+        os.makedirs(directory, exist_ok=True)
+        arrays = dict(self.columns,
+                      offsets=self.offsets,
+                      event_codes=self.event_codes,
+                      time_offsets=self.time_offsets,
+                      session_start=self.session_start)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f"{name}.npy"), array)
+        for name, values in self.vocabularies.items():
+            values.save(directory, f"vocabulary_{name}")
+        meta = {'tz': self.tz,
+                'columns': list(self.columns),
+                'vocabularies': list(self.vocabularies),
+                'dtypes': self.dtypes}
+        with open(os.path.join(directory, self.meta_file), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap_mode: str = None) -> 'SessionSequence':
+        """ Reads a sequence written by save
+
+        :param directory: directory passed to save
+        :param mmap_mode: passed to numpy.load, 'r' maps the arrays read-only instead of reading them
+        :return: sequence
+        """
+        with open(os.path.join(directory, cls.meta_file)) as f:
+            meta = json.load(f)
+
+        def read(name: str) -> np.ndarray:
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        return cls(read('offsets'),
+                   read('event_codes'),
+                   read('time_offsets'),
+                   read('session_start'),
+                   {name: read(name) for name in meta['columns']},
+                   {name: StringArray.load(directory, f"vocabulary_{name}", mmap_mode)
+                    for name in meta['vocabularies']},
+                   meta['tz'],
+                   meta.get('dtypes'))
+
+    def sessions_per_path(self, session_mask: np.ndarray = None) -> List[Tuple[str, int]]:
+        """ Number of sessions of every path_nickname, most frequent first
+        """
+        codes = self.columns['path_nickname'] if session_mask is None else self.columns['path_nickname'][session_mask]
+        counts = np.bincount(codes[codes >= 0], minlength=len(self.vocabularies['path_nickname']))
+        order = np.argsort(-counts, kind='mergesort')
+        return [(self.vocabularies['path_nickname'][i], int(counts[i])) for i in order if counts[i] > 0]
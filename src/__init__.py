@@ -1,5 +1,14 @@
 from .sankey_flow.SankeyFlow import SankeyFlow
+from .NumberClassifier.NumberClassifier import NumberClassifier
+from .QueryCache.QueryCache import QueryCache
+from .QueryScheduler.QueryScheduler import QueryScheduler
+from .JobQueue.JobQueue import JobQueue, JobCancelled
+from .SessionSequence.SessionSequence import SessionSequence
+from .AggregateStore.AggregateStore import AggregateStore
+from .SessionIndex.SessionIndex import SessionIndex, SessionBitmap
+from .HyperLogLog.HyperLogLog import HyperLogLog
+from .Funnel.Funnel import Funnel
 from .Flow.Flow import Flow
 from .CpassStatus.CpassStatus import CpassStatus
 
-__all__ = ['SankeyFlow', 'Flow', 'CpassStatus']
\ No newline at end of file
+__all__ = ['SankeyFlow', 'NumberClassifier', 'QueryCache', 'QueryScheduler', 'JobQueue', 'JobCancelled', 'SessionSequence', 'AggregateStore', 'SessionIndex', 'SessionBitmap', 'HyperLogLog', 'Funnel', 'Flow', 'CpassStatus']
\ No newline at end of file
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import datetime
 import time
@@ -15,6 +16,8 @@ class SankeyFlow:
     title = None
     path_highlight = '1-Path_Freq_Rank'
     _threshold = 0
+    # set by background jobs, anything with a check(stage) method that raises when the job is stale
+    cancel_token = None
 
     def __init__(self, data: pd.DataFrame = None, palette: list = None) -> None:
         self._data = data
@@ -44,6 +47,14 @@ class SankeyFlow:
             self._threshold = int(self.sourceTargetDf['count'].max() * (value / 100))
         print(f"threshold set to {self._threshold} by parameter {value}")
 
+    def _check_cancelled(self, stage: str) -> None:
+        """ Stops the current computation if the job running it has been superseded
+
+        :param stage: name of the stage about to start
+        """
+        if self.cancel_token is not None:
+            self.cancel_token.check(stage)
+
     @staticmethod
     def _build_node_dict(data: pd.DataFrame, palette: list) -> dict:
 
@@ -84,6 +95,7 @@ class SankeyFlow:
             labelList += [event for event in ideal_node_locations.sort_values('rank_event')[cat_col].to_list()
                          if event not in labelList]
         print(f"labelList created in {round((time.time() - start_time) * 60, 2)}")
+        self._check_cancelled('sourceTargetDf')
 
         # define colors based on number of levels
         # colorList = []
@@ -103,13 +115,22 @@ class SankeyFlow:
                 sourceTargetDf = pd.concat([sourceTargetDf, tempDf])
         '''
         start_time = time.time()
+        aggregations = {'count': 'sum', 'time_from_start': 'mean'}
+        # sampled data carries the variance of each weighted count
+        if 'count_var' in df.columns:
+            value_cols = value_cols + ['count_var']
+            aggregations['count_var'] = 'sum'
         sourceTargetDf = df[cat_cols + value_cols + color_col]
         sourceTargetDf.columns = ['source', 'target'] + value_cols + color_col
         sourceTargetDf = (sourceTargetDf
                           .groupby(['source', 'target'] + color_col)
-                          .agg({'count': 'sum', 'time_from_start': 'mean'})
+                          .agg(aggregations)
                           .reset_index())
+        if 'count_var' in sourceTargetDf.columns:
+            sourceTargetDf['count'] = sourceTargetDf['count'].round()
+            sourceTargetDf['count_error'] = (1.96 * np.sqrt(sourceTargetDf.pop('count_var'))).round()
         print(f"sourceTargetDf created in {round((time.time() - start_time) * 60, 2)}")
+        self._check_cancelled('sourceID')
 
         # add index for source-target pair
         start_time = time.time()
@@ -125,6 +146,42 @@ class SankeyFlow:
 
         return labelList, colorList, sourceTargetDf
 
+    def build_sourceTargetDf_from_aggregates(self,
+                                             edges: pd.DataFrame,
+                                             node_ranks: pd.DataFrame):
+        """ Same output as build_sourceTargetDf, built from pre-aggregated tables instead
+            of event rows
+
+        :param edges: rows of event_name, next_event, path_nickname with count, time_sum and time_n
+        :param node_ranks: rows of column, node, rank_event with the number of events at that rank
+        :return: labelList, colorList, sourceTargetDf
+        """
+        colorPalette = ['#4B8BBE', '#306998', '#FFE873', '#FFD43B', '#646464']
+        labelList = []
+        for cat_col in ['event_name', 'next_event']:
+            counts = (node_ranks[node_ranks['column'] == cat_col]
+                      .groupby(['node', 'rank_event'])['count'].sum()
+                      .reset_index())
+            # the mode of rank_event, the lowest rank wins ties like Series.mode()
+            modes = (counts.sort_values(['node', 'count', 'rank_event'], ascending=[True, False, True])
+                     .drop_duplicates('node'))
+            labelList += [event for event in modes.sort_values('rank_event')['node'].to_list()
+                          if event not in labelList]
+        self._check_cancelled('sourceTargetDf')
+        colorList = [colorPalette[0]] * len(labelList)
+
+        sourceTargetDf = (edges.groupby(['event_name', 'next_event', 'path_nickname'])
+                          .agg({'count': 'sum', 'time_sum': 'sum', 'time_n': 'sum'})
+                          .reset_index()
+                          .rename(columns={'event_name': 'source', 'next_event': 'target'}))
+        sourceTargetDf['time_from_start'] = sourceTargetDf['time_sum'] / sourceTargetDf['time_n']
+        sourceTargetDf = sourceTargetDf.drop(columns=['time_sum', 'time_n'])
+        label_ids = {label: i for i, label in enumerate(labelList)}
+        sourceTargetDf['sourceID'] = sourceTargetDf['source'].map(label_ids)
+        sourceTargetDf['targetID'] = sourceTargetDf['target'].map(label_ids)
+
+        return labelList, colorList, sourceTargetDf
+
     def genSankey(self,
                   sourceTargetDf,
                   labelList,
@@ -141,6 +198,15 @@ class SankeyFlow:
             print("Colored path is none")
         # sourceTargetDf.loc[sourceTargetDf['callback_instance'] == 1, 'color'] = '#800000'
         sourceTargetDf = sourceTargetDf[sourceTargetDf['count'] >= threshold]
+        hovertemplate = ('%{value} unique users went from %{source.label} to %{target.label}.<br />' +
+                         'on path %{customdata} ' +
+                         '<br />It took them %{label} seconds on average from the start of the flow to finish ' +
+                         'event %{target.label}.<extra></extra>')
+        customdata = sourceTargetDf['path_nickname']
+        if 'count_error' in sourceTargetDf.columns:
+            hovertemplate = hovertemplate.replace('%{customdata}', '%{customdata[0]}').replace(
+                'unique users', 'unique users (±%{customdata[1]}, 95%, sampled)')
+            customdata = sourceTargetDf[['path_nickname', 'count_error']].values
         # creating the sankey diagram
         data = dict(
             type='sankey',
@@ -160,11 +226,8 @@ class SankeyFlow:
                 value=sourceTargetDf['count'],
                 color=sourceTargetDf['color'],
                 label=sourceTargetDf['time_from_start'],
-                customdata=sourceTargetDf['path_nickname'],
-                hovertemplate='%{value} unique users went from %{source.label} to %{target.label}.<br />' +
-                              'on path %{customdata} ' +
-                              '<br />It took them %{label} seconds on average from the start of the flow to finish ' +
-                              'event %{target.label}.<extra></extra>'
+                customdata=customdata,
+                hovertemplate=hovertemplate
             )
         )
 
@@ -193,6 +256,7 @@ class SankeyFlow:
         start_time = time.time()
         self.labelList, self.colorList, self.sourceTargetDf = self.build_sourceTargetDf(data,
                                                                                         color_col=['path_nickname'])
+        self._check_cancelled('genSankey')
 
         fig = self.genSankey(
             self.sourceTargetDf,